@@ -0,0 +1,202 @@
+# Mixer channel pool for dense, overlapping sound cues
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from sound_cache import StreamedSound, mixer
+
+#  Upper bound for mixer channels, every channel costs mixing time on the Pi
+MAX_CHANNELS = 32
+#  Seconds added to every reservation, a sequence starts a moment after it was planned
+_SLACK = 0.05
+
+
+class ChannelManager:
+    """
+    Assigns every audio cue of a sequence its own mixer channel before the show
+    starts, sized from the maximum number of overlapping sounds. Reservations
+    are booked in absolute time per channel, so sequences merged into running
+    ones get channels those do not need. If a reserved channel is unexpectedly
+    busy (or the overlap exceeds MAX_CHANNELS), the cue takes a free channel or
+    steals the one playing the lowest priority cue.
+    """
+
+    def __init__(self, max_channels:int = MAX_CHANNELS):
+        self.max_channels = max_channels
+        self.count = 0
+        self._ends:list[float] = []
+        self._priorities:list[int] = []
+        #  Sequence that started the last sound of every channel and of the music stream
+        self._owners:list[int|None] = []
+        self._music_owner = None
+        self._music_end = 0.0
+        #  Per channel: (start, end, owner) of every reservation, sorted and never overlapping
+        self._bookings:list[list[tuple[float, float, int]]] = []
+        #  Sequences are planned outside the player thread
+        self._lock = threading.Lock()
+        #  Streamed tracks still to play as (owner, track) in cue order, and the track the music stream has open
+        self._music_pending:deque = deque()
+        self._music_loaded = None
+        self._music_lock = threading.Lock()
+
+    def _resize(self, count:int):
+        count = min(count, self.max_channels)
+        if count > self.count:
+            mixer().set_num_channels(count)
+            self._ends.extend([0.0] * (count - self.count))
+            self._priorities.extend([0] * (count - self.count))
+            self._owners.extend([None] * (count - self.count))
+            self.count = count
+
+    def plan(self, cues:list[tuple[int, float]], owner:int = 0, origin:float|None = None) -> list[int|None]:
+        """
+        Reserves channels for cues given as (start ms, length s) in start order,
+        for a sequence starting at origin (now by default). Channels booked by
+        other sequences at the same time are avoided. Returns the channel index
+        of every cue (None if the pool is exhausted).
+        """
+        if not mixer().get_init():
+            return [None] * len(cues)
+        if origin is None:
+            origin = time.perf_counter()
+        reservations:list[int|None] = []
+        with self._lock:
+            self._resize(mixer().get_num_channels())
+            #  Reservations that have ended are of no use anymore
+            self._bookings = [[booking for booking in booked if booking[1] > origin] for booked in self._bookings]
+            for start, length in cues:
+                begin = origin + start / 1000
+                end = begin + length + _SLACK
+                for channel in range(self.max_channels):
+                    if channel == len(self._bookings):
+                        self._bookings.append([])
+                    booked = self._bookings[channel]
+                    #  Bookings of a channel do not overlap, so only the last one starting before end can
+                    index = bisect_left(booked, (end,))
+                    if index == 0 or booked[index - 1][1] <= begin:
+                        booked.insert(index, (begin, end, owner))
+                        reservations.append(channel)
+                        break
+                else:
+                    reservations.append(None)
+            self._resize(max((channel + 1 for channel in reservations if channel is not None), default=0))
+        return reservations
+
+    def release(self, owner:int):
+        """Drops the reservations of a sequence that ended or was stopped."""
+        with self._lock:
+            self._bookings = [[booking for booking in booked if booking[2] != owner] for booked in self._bookings]
+        with self._music_lock:
+            self._music_pending = deque(entry for entry in self._music_pending if entry[0] != owner)
+
+    def plan_music(self, tracks:list[StreamedSound], owner:int = 0):
+        """Queues the streamed tracks of a sequence in cue order and opens the first if the stream is free."""
+        with self._music_lock:
+            self._music_pending.extend((owner, track) for track in tracks)
+        self.load_music()
+
+    def load_music(self):
+        """
+        Opens the next streamed track once the music stream is idle, so its cue
+        only has to start playback. Called when there is time before the next cue.
+        """
+        with self._music_lock:
+            if not self._music_pending:
+                return
+            track = self._music_pending[0][1]
+            if track.path == self._music_loaded or mixer().music.get_busy():
+                return
+            track.load()
+            self._music_loaded = track.path
+
+    def _find_channel(self, priority:int, now:float) -> int|None:
+        """A free channel, a new one, or the busy one with the lowest lower priority."""
+        for index in range(self.count):
+            if self._ends[index] <= now and not mixer().Channel(index).get_busy():
+                return index
+        if self.count < self.max_channels:
+            self._resize(self.count + 1)
+            return self.count - 1
+        victim = min(range(self.count), key=self._priorities.__getitem__)
+        if self._priorities[victim] < priority:
+            mixer().Channel(victim).stop()
+            return victim
+        return None
+
+    def play(self, sound, volume:int, reservation:int|None = None, priority:int = 0, owner:int|None = None) -> bool:
+        """Starts a sound of sequence owner on its reserved channel (or a stolen one). False if dropped."""
+        now = time.perf_counter()
+        if isinstance(sound, StreamedSound):
+            #  Long tracks use the music stream, which replaces the previous track
+            with self._music_lock:
+                if self._music_pending and self._music_pending[0][1].path == sound.path:
+                    self._music_pending.popleft()
+                if self._music_loaded != sound.path:
+                    #  Not opened in advance (e.g. the previous track was still playing)
+                    sound.load()
+                    self._music_loaded = sound.path
+                sound.play(max(0.0, min(1.0, volume / 100)))
+                self._music_owner = owner
+            self._music_end = now + sound.get_length()
+            return True
+        index = reservation
+        if index is None or index >= self.count or mixer().Channel(index).get_busy():
+            index = self._find_channel(priority, now)
+            if index is None:
+                return False
+        channel = mixer().Channel(index)
+        channel.play(sound)
+        #  Per channel volume, the cached Sound object is shared between cues
+        channel.set_volume(max(0.0, min(1.0, volume / 100)))
+        self._ends[index] = now + sound.get_length()
+        self._priorities[index] = priority
+        self._owners[index] = owner
+        return True
+
+    def wait_idle(self, stop_event):
+        """
+        Blocks until the last playing sound has ended, by sleeping until its
+        known end time rather than polling. Returns early if stop_event is set.
+        """
+        while True:
+            remaining = max(self._ends, default=0.0) - time.perf_counter()
+            remaining = max(remaining, self._music_end - time.perf_counter())
+            if remaining > 0:
+                if stop_event.wait(remaining):
+                    return
+            if not mixer().get_busy() and not mixer().music.get_busy():
+                return
+            #  Output ran behind the computed end, check again shortly
+            if stop_event.wait(0.05):
+                return
+
+    def stop(self, owner:int):
+        """
+        Stops the sounds a cancelled sequence is still playing and drops its
+        reservations. Bookings of other sequences, including one about to start
+        in its place, stay untouched.
+        """
+        for index in range(self.count):
+            if self._owners[index] == owner:
+                mixer().Channel(index).stop()
+                self._ends[index] = 0.0
+                self._priorities[index] = 0
+                self._owners[index] = None
+        with self._music_lock:
+            if self._music_owner == owner:
+                mixer().music.stop()
+                self._music_owner = None
+                self._music_end = 0.0
+        self.release(owner)
+
+    def reset(self):
+        """Forgets all running sounds, e.g. after mixer().stop()."""
+        self._ends = [0.0] * self.count
+        self._priorities = [0] * self.count
+        self._owners = [None] * self.count
+        self._music_owner = None
+        self._music_end = 0.0
+        with self._lock:
+            self._bookings = []
+        with self._music_lock:
+            self._music_pending.clear()
@@ -0,0 +1,191 @@
+# Content-addressed store for uploaded audio with a disk quota
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from pcm_file import pcm_path, remove_pcm
+from sound_cache import sound_cache
+from service_log import get_logger
+
+log = get_logger(__name__)
+
+"""
+Uploaded audio is stored once per content as .objects/<sha256>. Every name a
+sequence may refer to is a symlink to its object, so identical files under
+different names take the space once and share one PCM sidecar.
+
+The index (.library.json) maps names to hashes and records size and last use
+of every object. Once the quota is exceeded, the least recently used objects
+are evicted together with their names.
+"""
+
+OBJECTS_DIR_NAME = ".objects"
+INDEX_NAME = ".library.json"
+#  Disk space for audio objects and their PCM sidecars in bytes
+DEFAULT_QUOTA = 1024 * 1024 * 1024
+
+
+def is_sha256(text:str) -> bool:
+    return len(text) == 64 and all(char in "0123456789abcdef" for char in text)
+
+
+class AudioLibrary:
+    """
+    Name -> hash -> file store of the uploaded audio. The index is loaded on
+    first use; plain files found then (uploaded before the library existed)
+    are adopted.
+    """
+
+    def __init__(self, directory:Path, quota:int = DEFAULT_QUOTA):
+        self.directory = directory
+        self.objects = directory / OBJECTS_DIR_NAME
+        self.quota = quota
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.names:dict[str, str] = {}     #  name -> sha256
+        self.entries:dict[str, dict] = {}  #  sha256 -> {"size": bytes, "used": unix time}
+
+    def _index_path(self) -> Path:
+        return self.directory / INDEX_NAME
+
+    def _load(self):
+        """Reads the index and adopts plain audio files (lock held)."""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            index = json.loads(self._index_path().read_text())
+            self.names = dict(index["names"])
+            self.entries = dict(index["objects"])
+        except (OSError, ValueError, KeyError) as e:
+            if self._index_path().exists():
+                log.warning(f"[?] Audio library index unreadable, rebuilding: {e}")
+
+        #  Forget what is no longer on disk
+        self.entries = {digest: entry for digest, entry in self.entries.items() if (self.objects / digest).exists()}
+        self.names = {name: digest for name, digest in self.names.items()
+                      if digest in self.entries and (self.directory / name).is_symlink()}
+
+        if self.directory.is_dir():
+            for path in self.directory.iterdir():
+                if path.name.startswith(".") or path.is_symlink() or not path.is_file():
+                    continue
+                with open(path, "rb") as file:
+                    digest = hashlib.file_digest(file, "sha256").hexdigest()
+                self._store(path, digest)
+        self._save()
+
+    def _save(self):
+        """Writes the index atomically (lock held)."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(dir=self.directory, prefix=f"{INDEX_NAME}.", suffix=".part")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump({"names": self.names, "objects": self.entries}, file)
+            os.replace(temp_name, self._index_path())
+        except BaseException:
+            Path(temp_name).unlink(missing_ok=True)
+            raise
+
+    def _link(self, name:str, digest:str):
+        """Points a name at an object, replacing whatever had that name (lock held)."""
+        target = self.directory / name
+        if target.is_symlink() or target.exists():
+            target.unlink()
+        target.symlink_to(Path(OBJECTS_DIR_NAME) / digest)
+        self.names[name] = digest
+        sound_cache.invalidate(target)
+
+    def _store(self, path:Path, digest:str):
+        """Moves a file into the object store and links its name (lock held)."""
+        self.objects.mkdir(parents=True, exist_ok=True)
+        #  A sidecar of the plain file would be orphaned, the object gets its own
+        remove_pcm(path)
+        stored = self.objects / digest
+        if stored.exists():
+            path.unlink()
+        else:
+            os.replace(path, stored)
+        self._link(path.name, digest)
+        entry = self.entries.setdefault(digest, {"size": stored.stat().st_size, "used": 0})
+        entry["used"] = time.time()
+
+    def _remove(self, digest:str) -> int:
+        """Deletes an object, its sidecar and its names; returns the bytes freed (lock held)."""
+        stored = self.objects / digest
+        freed = self._disk_usage(digest)
+        for name in [name for name, other in self.names.items() if other == digest]:
+            del self.names[name]
+            (self.directory / name).unlink(missing_ok=True)
+            sound_cache.invalidate(self.directory / name)
+        remove_pcm(stored)
+        stored.unlink(missing_ok=True)
+        del self.entries[digest]
+        log.info(f"[*] Evicted audio {digest[:12]} ({freed} bytes)")
+        return freed
+
+    def _disk_usage(self, digest:str) -> int:
+        try:
+            sidecar = pcm_path(self.objects / digest).stat().st_size
+        except OSError:
+            sidecar = 0
+        return self.entries[digest]["size"] + sidecar
+
+    def _evict(self, protect:set[str]):
+        """Evicts least recently used objects until the quota is met (lock held)."""
+        usage = sum(self._disk_usage(digest) for digest in self.entries)
+        for digest in sorted(self.entries, key=lambda digest: self.entries[digest]["used"]):
+            if usage <= self.quota:
+                break
+            if digest not in protect:
+                usage -= self._remove(digest)
+
+    def load(self):
+        """Loads the index now instead of on first use."""
+        with self._lock:
+            self._load()
+
+    def add(self, path:Path, digest:str, protect=()):
+        """
+        Takes a freshly uploaded file into the store. protect lists names whose
+        audio must survive the eviction this may trigger (e.g. of the current sequence).
+        """
+        with self._lock:
+            self._load()
+            self._store(path, digest)
+            protected = {self.names[name] for name in protect if name in self.names}
+            self._evict(protected | {digest})
+            self._save()
+
+    def missing(self, wanted:list[tuple[str|None, str]]) -> list[str]:
+        """
+        Takes (name, sha256) pairs a client wants to use. Known content is linked
+        under the name right away; returns the hashes that have to be uploaded.
+        """
+        missing = []
+        with self._lock:
+            self._load()
+            for name, digest in wanted:
+                if digest not in self.entries:
+                    missing.append(digest)
+                    continue
+                self.entries[digest]["used"] = time.time()
+                name = Path(name).name if name else None
+                if name and not name.startswith(".") and self.names.get(name) != digest:
+                    self._link(name, digest)
+            self._save()
+        return missing
+
+    def touch(self, names):
+        """Marks the audio of a sequence as just used."""
+        now = time.time()
+        with self._lock:
+            self._load()
+            for name in names:
+                digest = self.names.get(name)
+                if digest is not None:
+                    self.entries[digest]["used"] = now
+            self._save()
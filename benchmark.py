@@ -0,0 +1,312 @@
+# Benchmark suite for sequence conversion, playback timing and audio upload
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import platform
+import random
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from convert_data import compile_transmission, convert_to_input
+from gpio_backend import PinDriver, SimulatedGPIOBackend
+from ecospark_pin import process_instruction_list
+from telemetry import CueRecorder
+import service_log
+
+"""
+Generates synthetic shows and measures:
+
+    conversion  convert_to_input + sort_merge_stop and compile_transmission (time, peak memory)
+    scheduling  cue lateness percentiles of the playback loop against fake GPIO/mixer
+    upload      command 3 throughput (text/base64 and framed/raw) over a socketpair
+    simulation  dry run of a 30 minute show on the virtual clock (see simulator.py)
+
+Results are written as JSON; --compare prints the change against an earlier run.
+
+    python benchmark.py --output results.json --compare baseline.json
+"""
+
+#  BCM pins available on the header
+PINS = list(range(2, 28))
+
+
+def generate_show(cues:int, duration_ms:int, seed:int = 0) -> str:
+    """
+    Builds a transmission with roughly `cues` events from a mix of light
+    (some blinking), three_d and sound effects spread over duration_ms.
+    """
+    rng = random.Random(seed)
+    records:list[str] = []
+    produced = 0
+    while produced < cues:
+        start = rng.randrange(duration_ms)
+        end = start + rng.randint(50, 5000)
+        pins = "/".join(str(pin) for pin in rng.sample(PINS, rng.randint(1, 3)))
+        kind = rng.random()
+        if kind < 0.3:
+            frequency = rng.choice((100, 200, 500, 1000))
+            records.append(f"light,{pins},{start},{end},{frequency}")
+            produced += 2 + max(1, (end - start - 1) // -(-frequency // 2))
+        elif kind < 0.6:
+            records.append(f"light,{pins},{start},{end}")
+            produced += 2
+        elif kind < 0.9:
+            records.append(f"three_d,{pins},{start},{end}")
+            produced += 2
+        else:
+            records.append(f"sound,cue{rng.randrange(20)}.wav,{start},{rng.randint(0, 100)}")
+            produced += 1
+    return "?".join(records)
+
+
+def _measure(function, *args):
+    """Returns (seconds, peak bytes) of one call; memory is measured in a second run."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - started
+        tracemalloc.start()
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_conversion(sizes:list[int]) -> list[dict]:
+    results = []
+    for cues in sizes:
+        transmission = generate_show(cues, duration_ms=cues * 20)
+        text_seconds, text_peak = _measure(convert_to_input, transmission)
+        compiled_seconds, compiled_peak = _measure(compile_transmission, transmission)
+        results.append({
+            "cues": cues,
+            "records": transmission.count("?") + 1,
+            "convert_to_input_s": text_seconds,
+            "convert_to_input_peak_bytes": text_peak,
+            "compile_transmission_s": compiled_seconds,
+            "compile_transmission_peak_bytes": compiled_peak,
+        })
+        print(f"[*] conversion {cues:>6} cues: text {text_seconds * 1000:8.1f} ms {text_peak / 1048576:7.2f} MiB"
+              f" | compiled {compiled_seconds * 1000:8.1f} ms {compiled_peak / 1048576:7.2f} MiB")
+    return results
+
+
+class FakeAudio:
+    """Audio controller stand-in that plays nothing."""
+
+    def __init__(self):
+        self.played = 0
+
+    @staticmethod
+    def prepare(timeline, sound_files, owner=0):
+        return []
+
+    @staticmethod
+    def release(owner):
+        pass
+
+    @staticmethod
+    def load_music():
+        pass
+
+    def play(self, file_path, volume=100, channel=None, owner=None):
+        self.played += 1
+        return True
+
+    @staticmethod
+    def wait_idle(stop_event):
+        pass
+
+
+def _percentile(ordered:list[float], fraction:float) -> float:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def bench_scheduling(cues:int, duration_ms:int) -> dict:
+    timeline = compile_transmission(generate_show(cues, duration_ms, seed=1))
+    recorder = CueRecorder(capacity=cues * 2)
+    backend = SimulatedGPIOBackend(record=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        process_instruction_list(timeline, FakeAudio(), threading.Event(), PinDriver(backend), recorder)
+    ordered = sorted(recorder.lateness_ms())
+    result = {
+        "cues": cues,
+        "duration_ms": duration_ms,
+        "measured_cues": len(ordered),
+        "p50_ms": _percentile(ordered, 0.50),
+        "p90_ms": _percentile(ordered, 0.90),
+        "p99_ms": _percentile(ordered, 0.99),
+        "max_ms": ordered[-1] if ordered else 0.0,
+        "histograms": recorder.report(),
+    }
+    print(f"[*] scheduling {len(ordered)} cues: p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms,"
+          f" max {result['max_ms']:.3f} ms")
+    return result
+
+
+def bench_simulation(cues:int, duration_ms:int) -> dict:
+    from simulator import simulate
+
+    timeline = compile_transmission(generate_show(cues, duration_ms, seed=3))
+    simulation = simulate(timeline)
+    result = {
+        "cues": cues,
+        "duration_ms": duration_ms,
+        "events": len(timeline),
+        "pin_changes": simulation.pin_changes(),
+        "audio_cues": len(simulation.audio_cues),
+        "seconds": simulation.wall_seconds,
+        "speedup": simulation.duration / simulation.wall_seconds,
+    }
+    print(f"[*] simulation {result['pin_changes']} pin changes, {result['audio_cues']} audio cues:"
+          f" {duration_ms / 60000:.0f} min show in {simulation.wall_seconds * 1000:.1f} ms")
+    return result
+
+
+def _payload(size:int) -> tuple[bytes, bytes]:
+    """
+    Random file content. Its base64 form contains "END" (more often than real
+    audio does) but never on a quantum boundary, where the end of a received
+    chunk could make it the end of the upload. Returns (raw bytes, base64 text).
+    """
+    rng = random.Random(2)
+    alphabet = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+    quanta = [bytes(rng.choice(alphabet) for _ in range(4)) for _ in range(-(-size // 3))]
+    for index in range(0, len(quanta), 97):
+        quanta[index] = b"QEND"
+    #  The only "END" left in the text starts off a boundary
+    text = b"".join(b"QENC" if quantum[:3] == b"END" else quantum for quantum in quanta)
+    return base64.b64decode(text), text
+
+
+def _serve_one(server_sock, directory:Path):
+    """Runs one ClientSession on the server end of a socketpair."""
+    import bluetooth_service
+    from audio_library import AudioLibrary
+
+    bluetooth_service.INSTRUCTIONS_DIR = directory
+    bluetooth_service.state.library = AudioLibrary(directory)
+
+    async def run():
+        server_sock.setblocking(False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            await bluetooth_service.ClientSession(server_sock, "benchmark").run()
+
+    asyncio.run(run())
+
+
+def _read_reply(sock, framed:bool) -> bytes:
+    data = sock.recv(65536)
+    if framed:
+        return data[8:]
+    return data
+
+
+def bench_upload(size:int) -> dict:
+    import bluetooth_service
+    from protocol import encode_frame, FRAME_LOGIN, FRAME_FILE_START, FRAME_FILE_DATA, FRAME_FILE_END
+
+    raw, text = _payload(size)
+    results = {"bytes": len(raw)}
+    with tempfile.TemporaryDirectory() as directory:
+        for framed in (False, True):
+            client, server = socket.socketpair()
+            thread = threading.Thread(target=_serve_one, args=(server, Path(directory)), daemon=True)
+            thread.start()
+            login = bluetooth_service.hashed_password.encode()
+            client.sendall(encode_frame(FRAME_LOGIN, login) if framed else b"0" + login)
+            _read_reply(client, framed)
+
+            started = time.perf_counter()
+            if framed:
+                client.sendall(encode_frame(FRAME_FILE_START, b"bench.wav"))
+                _read_reply(client, framed)
+                view = memoryview(raw)
+                for offset in range(0, len(view), 32768):
+                    client.sendall(encode_frame(FRAME_FILE_DATA, view[offset:offset + 32768]))
+                client.sendall(encode_frame(FRAME_FILE_END))
+            else:
+                client.sendall(b"3:bench.wav:START")
+                _read_reply(client, framed)
+                client.sendall(text + b"END")
+            reply = _read_reply(client, framed)
+            elapsed = time.perf_counter() - started
+            client.close()
+            thread.join()
+
+            name = "framed" if framed else "text"
+            if b"gespeichet" not in reply:
+                raise RuntimeError(f"{name} upload failed: {reply!r}")
+            results[f"{name}_s"] = elapsed
+            results[f"{name}_mib_per_s"] = len(raw) / elapsed / 1048576
+            print(f"[*] upload {name:>6}: {len(raw) / 1048576:.1f} MiB in {elapsed * 1000:.1f} ms"
+                  f" ({results[f'{name}_mib_per_s']:.1f} MiB/s)")
+    return results
+
+
+def compare(current:dict, baseline:dict):
+    """Prints the relative change of every numeric metric against a baseline run."""
+    def walk(new, old, prefix):
+        if isinstance(new, dict) and isinstance(old, dict):
+            for key in new:
+                if key in old:
+                    walk(new[key], old[key], f"{prefix}{key}.")
+        elif isinstance(new, list) and isinstance(old, list):
+            for index, (a, b) in enumerate(zip(new, old)):
+                walk(a, b, f"{prefix}{index}.")
+        elif isinstance(new, (int, float)) and isinstance(old, (int, float)) and old:
+            print(f"{prefix[:-1]:<55} {old:>14.4g} -> {new:>14.4g} ({(new - old) / old * 100:+.1f}%)")
+    walk(current, baseline, "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EcoSpark benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="cue counts of the conversion benchmark")
+    parser.add_argument("--schedule-cues", type=int, default=2000)
+    parser.add_argument("--schedule-ms", type=int, default=5000,
+                        help="length of the show played in real time")
+    parser.add_argument("--upload-bytes", type=int, default=4 * 1048576)
+    parser.add_argument("--simulate-cues", type=int, default=20000)
+    parser.add_argument("--simulate-ms", type=int, default=30 * 60 * 1000,
+                        help="length of the show played on the virtual clock")
+    parser.add_argument("--only", choices=("conversion", "scheduling", "upload", "simulation"), nargs="+")
+    parser.add_argument("--log-level", default="warning",
+                        help="service log level during the runs (production: warning)")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--compare", type=Path, help="earlier results to compare against")
+    args = parser.parse_args()
+
+    only = set(args.only or ("conversion", "scheduling", "upload", "simulation"))
+    service_log.set_level(args.log_level)
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+        }
+    }
+    if "conversion" in only:
+        results["conversion"] = bench_conversion(args.sizes)
+    if "scheduling" in only:
+        results["scheduling"] = bench_scheduling(args.schedule_cues, args.schedule_ms)
+    if "upload" in only:
+        results["upload"] = bench_upload(args.upload_bytes)
+    if "simulation" in only:
+        results["simulation"] = bench_simulation(args.simulate_cues, args.simulate_ms)
+
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"[*] Results written to {args.output}")
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == '__main__':
+    main()
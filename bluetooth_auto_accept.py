@@ -1,14 +1,139 @@
-# Bluetooth Auto-Accept Script 
+# Bluetooth Auto-Accept Script
 # Erstellt von: Kjell Peteaux
+import os
+import re
+import shlex
 import subprocess
+import threading
 import time
 import signal
+from service_log import get_logger
+
+log = get_logger(__name__)
+
+"""
+All adapter settings go through one long-lived bluetoothctl process that is
+driven over a pipe. Instead of re-enabling discoverability on a timer, the
+manager reacts to the "Discoverable: no" change events bluetoothctl prints.
+
+$ECOSPARK_BLUETOOTHCTL overrides the command, e.g. "python fake_bluetoothctl.py".
+"""
+
+#  Seconds to wait for bluetoothctl to confirm a command
+COMMAND_TIMEOUT = 5.0
+
+#  Colour codes and readline markers in bluetoothctl output, and its prompt
+_ANSI = re.compile(r"\x1b\[[0-9;]*[A-Za-z]|[\x01\x02\r]")
+_PROMPT = re.compile(r"^(\[[^\]]*\]# ?)+")
+
+
+class _Waiter:
+    """Collects output lines for one request until a success or failure line."""
+
+    def __init__(self, success:tuple, failure:tuple):
+        self.success = success
+        self.failure = failure
+        self.lines:list[str] = []
+        self.succeeded = False
+        self.done = threading.Event()
+
+    def feed(self, line:str):
+        self.lines.append(line)
+        if any(text in line for text in self.failure):
+            self.done.set()
+        elif any(text in line for text in self.success):
+            self.succeeded = True
+            self.done.set()
+
+
+class BluetoothCtl:
+    """
+    Persistent bluetoothctl coprocess. Commands are written to its stdin, a
+    reader thread hands every output line to the pending request and to the
+    listeners (which must not issue requests themselves).
+    """
+
+    def __init__(self, command:str|None = None):
+        self.command = command or os.environ.get("ECOSPARK_BLUETOOTHCTL", "bluetoothctl")
+        self.process = None
+        self._lock = threading.Lock()
+        self._request_lock = threading.Lock()
+        self._waiter = None
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Calls listener(line) for every output line, listener(None) when the process exits."""
+        self._listeners.append(listener)
+
+    def start(self):
+        self.process = subprocess.Popen(shlex.split(self.command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True, bufsize=1)
+        threading.Thread(target=self._read, args=(self.process,), name="bluetoothctl", daemon=True).start()
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def _read(self, process):
+        for raw in process.stdout:
+            line = _PROMPT.sub("", _ANSI.sub("", raw)).strip()
+            if not line:
+                continue
+            with self._lock:
+                waiter = self._waiter
+            if waiter is not None:
+                waiter.feed(line)
+            for listener in self._listeners:
+                listener(line)
+        #  stdout closes before the process can be reaped; alive() must be False for the listeners
+        process.wait()
+        for listener in self._listeners:
+            listener(None)
+
+    def request(self, text:str, success, failure=("Failed", "not available", "Invalid command"),
+                timeout:float = COMMAND_TIMEOUT) -> list[str]|None:
+        """
+        Sends one or more command lines and waits for a line containing one of
+        the success texts. Returns the collected lines, None on failure or timeout.
+        """
+        if not self.alive():
+            return None
+        waiter = _Waiter(tuple([success] if isinstance(success, str) else success), tuple(failure))
+        with self._request_lock:
+            with self._lock:
+                self._waiter = waiter
+            try:
+                self.process.stdin.write(text + "\n")
+                self.process.stdin.flush()
+                waiter.done.wait(timeout)
+            except OSError:
+                return None
+            finally:
+                with self._lock:
+                    self._waiter = None
+        return waiter.lines if waiter.succeeded else None
+
+    def close(self):
+        if not self.alive():
+            return
+        try:
+            self.process.stdin.write("quit\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
 
 class BluetoothManager:
-    def __init__(self):
+    def __init__(self, ctl:BluetoothCtl|None = None):
         self.keep_running = True
-        signal.signal(signal.SIGINT, self._cleanup)
-        signal.signal(signal.SIGTERM, self._cleanup)
+        self.ctl = ctl or BluetoothCtl()
+        self.ctl.add_listener(self._on_output)
+        #  Set when discoverability was lost or bluetoothctl exited
+        self._changed = threading.Event()
+        #  Signal handlers can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self._cleanup)
+            signal.signal(signal.SIGTERM, self._cleanup)
 
     @staticmethod
     def _run_command(command, check=True):
@@ -23,95 +148,139 @@ class BluetoothManager:
     def _cleanup(self, _signum=None, _frame=None):
         """Cleanup Bluetooth settings on exit"""
         self.keep_running = False
-        self._run_command("bluetoothctl -- discoverable off")
-        self._run_command("bluetoothctl -- pairable off")
+        self.ctl.request("discoverable off", "discoverable off succeeded")
+        self.ctl.request("pairable off", "pairable off succeeded")
+        self.ctl.close()
+        self._changed.set()
+
+    def _on_output(self, line):
+        """Reader thread: wakes keep_discoverable only when something changed."""
+        if line is None or "Discoverable: no" in line:
+            self._changed.set()
 
     def reset_bluetooth(self):
         """Reset Bluetooth adapter completely"""
         commands = [
             "sudo systemctl stop bluetooth",
-            "sleep 2",
             "sudo rm -f /var/lib/bluetooth/*/settings",
             "sudo systemctl start bluetooth",
-            "sleep 2"
         ]
         for cmd in commands:
             if not self._run_command(cmd):
                 return False
         return True
 
+    def start_session(self):
+        """Starts the bluetoothctl coprocess"""
+        try:
+            self.ctl.start()
+            return True
+        except OSError as e:
+            log.error(f"[!] Could not start bluetoothctl: {e}")
+            return False
+
+    def adapter_ready(self):
+        """True if bluetoothd is running and reports a powered controller"""
+        lines = self.ctl.request("show", "Powered:", failure=("No default controller",), timeout=1.0)
+        return lines is not None and any("Powered: yes" in line for line in lines)
+
+    def wait_for_adapter(self, timeout=10.0):
+        """Waits until bluetoothd has a controller again (after a reset)"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.ctl.request("show", "Powered:", failure=("No default controller",), timeout=1.0) is not None:
+                return True
+            time.sleep(0.2)
+        return False
+
+    def prepare_adapter(self):
+        """Resets the adapter only if it is not already up"""
+        if not self.start_session():
+            return False
+        if self.adapter_ready():
+            log.info("[*] Bluetooth adapter already up, skipping reset")
+            return True
+        self.ctl.close()
+        if not self.reset_bluetooth():
+            return False
+        #  bluetoothctl waits for the restarted bluetoothd instead of fixed sleeps
+        return self.start_session() and self.wait_for_adapter()
+
     def setup_adapter(self):
         """Configure basic adapter settings"""
-        return self._run_command("""bluetoothctl <<EOF
-power on
-discoverable on
-pairable on
-EOF""")
+        #  Without a timeout the adapter never stops being discoverable by itself
+        self.ctl.request("discoverable-timeout 0", "discoverable-timeout 0 succeeded")
+        return all(self.ctl.request(f"{setting} on", f"{setting} on succeeded") is not None
+                   for setting in ("power", "discoverable", "pairable"))
 
     def remove_paired_devices(self):
         """Remove all paired devices"""
-        result = subprocess.run(
-            "bluetoothctl -- paired-devices | awk '{print $2}'",
-            shell=True, capture_output=True, text=True)
-        
-        devices = result.stdout.splitlines()
+        #  "paired-devices" was replaced by "devices Paired" in newer BlueZ; "version" ends the listing
+        lines = self.ctl.request("paired-devices\ndevices Paired\nversion", "Version", failure=())
+        devices = {line.split()[1] for line in lines or () if line.startswith("Device ")}
         for device in devices:
-            if device.strip():
-                self._run_command(f"bluetoothctl remove {device}")
+            self.ctl.request(f"remove {device}", ("Device has been removed", "not available"), failure=())
         return True
 
     def configure_io_capability(self):
         """Set IO capability to NoInputNoOutput"""
         return self._run_command("sudo btmgmt --index 0 io-cap 3 >/dev/null 2>&1")
 
-    @staticmethod
-    def register_agent():
-        """Register NoInputNoOutput agent"""
-        try:
-            subprocess.run(
-                ['expect', '-c', '''
-                spawn bluetoothctl
-                expect "#"
-                send "agent NoInputNoOutput\\r"
-                expect {
-                    "Agent registered" {}
-                    "Failed to register agent object" {exit 1}
-                }
-                send "default-agent\\r"
-                expect "Default agent request successful"
-                send "quit\\r"
-                expect eof
-                '''], 
-                check=True)
-            return True
-        except subprocess.CalledProcessError:
+    def register_agent(self):
+        """Register NoInputNoOutput agent (it lives as long as the bluetoothctl session)"""
+        if self.ctl.request("agent NoInputNoOutput", ("Agent registered", "Agent is already registered"),
+                            failure=("Failed to register agent object",)) is None:
             return False
+        return self.ctl.request("default-agent", "Default agent request successful") is not None
 
-    def keep_discoverable(self, interval=10):
-        """Keep Bluetooth discoverable alive"""
+    def keep_discoverable(self, restart_delay=1.0):
+        """
+        Keep Bluetooth discoverable alive: sleeps until the adapter reports it is
+        no longer discoverable (or bluetoothctl died) and only then acts.
+        """
         while self.keep_running:
-            self._run_command("bluetoothctl -- discoverable on >/dev/null 2>&1")
-            time.sleep(interval)
+            self._changed.wait()
+            self._changed.clear()
+            if not self.keep_running:
+                break
+            if not self.ctl.alive():
+                log.warning("[!] bluetoothctl exited, restarting session")
+                time.sleep(restart_delay)
+                if self.start_session():
+                    self.setup_adapter()
+                    self.register_agent()
+                continue
+            self.ctl.request("discoverable on", "discoverable on succeeded")
 
     def full_setup(self):
         """Run the complete setup sequence"""
         steps = [
-            self.reset_bluetooth,
+            self.prepare_adapter,
             self.setup_adapter,
             self.remove_paired_devices,
             self.configure_io_capability,
             self.register_agent
         ]
-        
+
         for step in steps:
             if not step():
                 return False
         return True
 
-def auto_accept_bluetooth():
-    manager = BluetoothManager()
-    if manager.full_setup():
+def auto_accept_bluetooth(ready=None):
+    """Sets the adapter up and keeps it discoverable. ready (a Future) gets the setup result."""
+    succeeded = False
+    try:
+        manager = BluetoothManager()
+        succeeded = manager.full_setup()
+    except Exception as e:
+        log.error(f"[!] Bluetooth setup crashed: {e}")
+    finally:
+        #  The service waits for the result before it listens
+        if ready is not None:
+            ready.set_result(succeeded)
+    if succeeded:
         manager.keep_discoverable()
 
 if __name__ == '__main__':
-    auto_accept_bluetooth()
\ No newline at end of file
+    auto_accept_bluetooth()
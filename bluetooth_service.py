@@ -1,180 +1,641 @@
-# Bluetooth service for Raspberry Pi 
+# Bluetooth service for Raspberry Pi
 # erstellt von: Levi Post
+import asyncio
+import codecs
+import json
+import os
+import re
 import socket
-import base64
-from pathlib import Path
 import hashlib
 import threading
+from concurrent.futures import Future
+import boot
 from bluetooth_auto_accept import auto_accept_bluetooth
-from convert_data import convert_to_input
-from convert_data import clean_base64
-from ecospark_pin import process_sequence
+from show_store import show_store
+from show_editor import ShowEditor
+from convert_data import RecordStream, iter_records
+from ecospark_pin import Player, INSTRUCTIONS_DIR, MODES, PREEMPT, QUEUE
+from sound_cache import sound_cache
+from audio_library import AudioLibrary, is_sha256
+from compression import Decompressor, negotiate
+from file_transfer import Base64FileReceiver, ChecksumError, FileReceiver
+from protocol import (FrameReader, ProtocolError, encode_frame, FRAME_MAGIC, FRAME_REPLY,
+                      FRAME_FILE_DATA, FRAME_FILE_END)
+from service_log import get_logger
+
+log = get_logger(__name__)
 
 """
 Bluetooth server for receiving commands to control GPIO pins and audio playback on a Raspberry Pi.
-"""
 
+Several control clients (e.g. the stage tablet and a monitoring laptop) can be
+connected at once. Each client speaks either the text protocol (one command per
+message, "<digit><payload>" or "<nn>:<payload>" from command 10 on) or the framed protocol from protocol.py; both are
+dispatched through the same handler table.
+
+Start-up is staged (see boot.py): Bluetooth setup and the mixer/GPIO/sound
+cache warm-up run concurrently, and clients are accepted as soon as the
+adapter is up. Commands needing the player wait for its warm-up.
+"""
 
-#  Initializing the stop event for sequence control
-stop_event = threading.Event()
 
 #  Constants for Bluetooth socket
 SERVER_ADDRESS = "B8:27:EB:CB:26:50"
 PORT = 1#  Port for RFCOMM
+MAX_CLIENTS = 4
 
 #  Bluetooth constants
 AF_BLUETOOTH = 31  #  From socket module
 SOCK_STREAM = socket.SOCK_STREAM
 BT_PROTO_RFCOMM = 3
 
-#  Start Bluetooth discoverability in a separate thread
-make_discoverable = threading.Thread(target=auto_accept_bluetooth)
-make_discoverable.start()
-
 #  Password for connection verification can be changed
-password = "15Punkte"  
-print(f"[*] Password is: {password}")
+password = "15Punkte"
 
 #  Hashing password for secure comparison
 hasher = hashlib.sha3_256()
 hasher.update(password.encode('utf8'))
 hashed_password = hasher.hexdigest()
 
+#  Two-digit commands of the text protocol ("10:<payload>")
+TEXT_COMMAND = re.compile(rb"(\d\d):")
+#  Largest decompressed sequence text accepted
+MAX_SEQUENCE_TEXT = 64 * 1024 * 1024
+
+
+class ServiceState:
+    """
+    State shared by all connected clients.
+    """
+
+    def __init__(self):
+        self.timeline = None
+        self.sessions = set()
+        self.player = None
+        self.player_ready:Future|None = None
+        #  Text of the last full sequence and its editable form (built on the first edit)
+        self.transmission = None
+        self.editor:ShowEditor|None = None
+        #  Uploaded audio, stored by content
+        self.library = AudioLibrary(INSTRUCTIONS_DIR)
+        self.edit_lock = asyncio.Lock()
+
+    async def get_editor(self) -> ShowEditor:
+        """The editable form of the current sequence, parsed from its text on first use."""
+        if self.editor is None:
+            self.editor = await asyncio.to_thread(ShowEditor.parse, self.transmission or "")
+        return self.editor
+
+    def player_started(self) -> bool:
+        """True once the player boot stage has finished successfully."""
+        if self.player is not None:
+            return True
+        ready = self.player_ready
+        return ready is not None and ready.done() and ready.exception() is None
+
+    async def get_player(self):
+        """The player, waiting for its boot stage if it is still warming up."""
+        if self.player is None and self.player_ready is not None:
+            self.player = await asyncio.wrap_future(self.player_ready)
+        return self.player
+
+
+state = ServiceState()
+
+#  Command number -> (handler, login required)
+HANDLERS:dict[int, tuple] = {}
+
+
+def command(number:int, login_required:bool = True):
+    """Registers an async handler(session, payload) for a command number."""
+    def register(handler):
+        HANDLERS[number] = (handler, login_required)
+        return handler
+    return register
+
+
+class ClientSession:
+    """
+    One connected client. Its messages are handled strictly in order, while
+    the event loop keeps serving the listener and the other clients.
+    """
+
+    def __init__(self, client_sock, client_info):
+        self.sock = client_sock
+        self.info = client_info
+        self.loop = asyncio.get_running_loop()
+        self.task = None
+        self.framed = False
+        self.logged_in = False
+        self.closed = False
+        self.upload = None
+        self.upload_checksum = None
+        #  Streamed sequence records (command 9 "stream") and their text decoder
+        self.records:RecordStream|None = None
+        self.decoder = None
+        #  Codec negotiated with command 11, and a compressed sequence being received
+        self.compression:str|None = None
+        self.inflater:Decompressor|None = None
+        self.sequence_parts:list[str] = []
+
+    async def reply(self, text:str):
+        if self.framed:
+            await self.loop.sock_sendall(self.sock, encode_frame(FRAME_REPLY, text.encode()))
+        else:
+            await self.loop.sock_sendall(self.sock, f"{text}\n".encode())
+
+    def close(self):
+        if self.upload is not None:
+            self.upload.abort()
+            self.upload = None
+        self.closed = True
+        self.sock.close()
+
+    async def dispatch(self, number:int, payload):
+        """Looks up the handler of a command and runs it if the client may."""
+        log.debug(f"[>] Received data of type {number}")
+        entry = HANDLERS.get(number)
+        if entry is None:
+            await self.reply(f"Unbekannter Befehl {number}")
+            return
+        handler, login_required = entry
+        if login_required and not self.logged_in:
+            await self.reply("Nicht angemeldet ")
+            log.warning(f"[!] Tried sending without being logged in")
+            return
+        await handler(self, payload)
+
+    async def run(self):
+        try:
+            first = await self.loop.sock_recv(self.sock, 32768)
+            #  Clients starting with the frame magic byte speak the framed protocol
+            if first[:1] == bytes([FRAME_MAGIC]):
+                self.framed = True
+                await self._run_framed(first)
+            else:
+                await self._run_text(first)
+        except (OSError, ProtocolError) as e:#  Handling socket errors and connection issues
+            log.error(f"[!] Error: {e}")
+        except Exception as e:#  Handling errors in data processing
+            log.error(f"[!] Error processing data: {e}")
+            try:
+                await self.reply(f"Fehler bei der Verarbeitung: {str(e)}")
+            except OSError:
+                pass
+        finally:
+            self.close()
+            state.sessions.discard(self)
+            log.info(f"[-] Connection closed: {self.info}")
+
+    async def _run_text(self, data:bytes):
+        while data and not self.closed:
+            #  A chunk can end a transfer and already carry the next command
+            while data and not self.closed:
+                data = await self._handle_text(data)
+            if self.closed:
+                return
+            data = await self.loop.sock_recv(self.sock, 32768)
+
+    async def _handle_text(self, data:bytes) -> bytes:
+        """Handles one received chunk, returns the bytes left for the next message."""
+        if self.upload is not None:
+            #  Base64 (or compressed) upload in progress, chunks go to the file until its end
+            rest = self.upload.feed_until_end(data)
+            if rest is None:
+                return b""
+            await finish_upload(self)
+            return rest
+        if self.records is not None:
+            #  Sequence stream in progress, records go to the editor until END
+            return await feed_records(self, data)
+        if self.inflater is not None:
+            #  Compressed sequence in progress, ends with its stream
+            return await feed_sequence(self, data)
+        message = data.strip()
+        two_digits = TEXT_COMMAND.match(message)
+        if two_digits:
+            await self.dispatch(int(two_digits[1]), message[two_digits.end():])
+        elif message:
+            await self.dispatch(int(message[:1]), message[1:])
+        return b""
+
+    async def _run_framed(self, first:bytes):
+        reader = FrameReader()
+        reader.feed(first)
+        while not self.closed:
+            for frame in reader.frames():
+                await self.dispatch(frame.type, frame.payload)
+                if self.closed:
+                    return
+            nbytes = await self.loop.sock_recv_into(self.sock, reader.get_buffer())
+            if not nbytes:
+                return
+            reader.buffer_updated(nbytes)
+
+
+@command(0, login_required=False)
+async def handle_login(session:ClientSession, payload):
+    """Connecting and checking password"""
+    received = bytes(payload).decode().strip()
+    log.debug(f"[!] received password hash: {received}")
+    if received == hashed_password:
+        await session.reply("Verbindung verifiziert")
+        log.info(f"[>] Received: connection verification")
+        session.logged_in = True
+    else:
+        await session.reply("Verbindung fehlgeschlagen")
+        log.warning(f"[!] Connection failed: incorrect password")
+        session.close()
+
+
+@command(1)
+async def handle_test(session:ClientSession, payload):
+    """Test message for debug purposes"""
+    await session.reply("Test erfolgreich ")
+    log.info(f"[>] Received: connection test")
+
+
+@command(2)
+async def handle_sequence(session:ClientSession, payload):
+    """
+    Send a sequence. The compiled show is cached under the SHA-256 of the
+    sequence text, so it can later be started with command 7 without resending.
+    With compression negotiated the payload (framed) or the data following
+    "2" (text protocol) is the compressed sequence.
+    """
+    if session.compression is not None:
+        session.inflater = Decompressor(session.compression, MAX_SEQUENCE_TEXT)
+        session.decoder = codecs.getincrementaldecoder("utf-8")()
+        session.sequence_parts = []
+        if session.framed:
+            await feed_sequence(session, payload)
+            if session.inflater is not None:
+                session.inflater = None
+                await session.reply("Komprimierte Abfolge unvollstaendig")
+        else:
+            await session.reply("Abfolge beginnt Transfer")
+        return
+    await store_sequence(session, bytes(payload).decode())
+
+
+async def feed_sequence(session:ClientSession, data) -> bytes:
+    """
+    Decompresses a chunk of a compressed sequence and stores it once the stream
+    ended. Returns the bytes that followed the end of the stream.
+    """
+    try:
+        for piece in session.inflater.feed(data):
+            session.sequence_parts.append(session.decoder.decode(piece))
+    except ValueError as e:
+        session.inflater = None
+        session.sequence_parts = []
+        await session.reply(str(e))
+        return b""
+    if not session.inflater.eof:
+        return b""
+    rest = session.inflater.unused_data
+    size = session.inflater.size
+    session.inflater = None
+    transmission = "".join(session.sequence_parts) + session.decoder.decode(b"", final=True)
+    session.sequence_parts = []
+    log.info(f"[*] Sequence decompressed ({size} bytes)")
+    await store_sequence(session, transmission)
+    return rest
+
+
+async def store_sequence(session:ClientSession, transmission:str):
+    """Makes a received sequence text the current sequence."""
+    await session.reply("Abfolge erfolgreich erhalten ")
+    log.info(f"[>] Received: sequence ({len(transmission)} characters)")
+    state.transmission = transmission
+    state.editor = None
+    #  Compiling large shows must not stall the other clients
+    key, state.timeline = await asyncio.to_thread(show_store.compile, transmission)
+    log.info(f"[*] Sequence {key[:12]} has {len(state.timeline)} events")
+    #  Decode referenced audio in the background before the show starts
+    sound_cache.preload(INSTRUCTIONS_DIR / sound for sound in state.timeline.sounds)
+
+
+@command(3)
+async def handle_file_start(session:ClientSession, payload):
+    """
+    Send an audio file.
+    Text protocol: "3:<name>:START[:<sha256>]", then base64 data and END (last in its
+    write or followed by a line break; the data up to it is whole base64 quanta).
+    Framed protocol: "<name>[:<sha256>]", then raw FRAME_FILE_DATA and FRAME_FILE_END.
+    With compression negotiated the file data is one compressed stream
+    (text protocol: raw, ending with the stream); the checksum is of the file itself.
+    """
+    header = bytes(payload).decode().strip()
+    if session.upload is not None:
+        session.upload.abort()
+        session.upload = None
+    await session.reply("Audio Datei beginnt Transfer")
+    log.info(f"[>] Received: Audio file")
+    if session.framed:
+        filename, _, checksum = header.partition(":")
+        session.upload = FileReceiver(INSTRUCTIONS_DIR, filename, session.compression, state.library.quota)
+    else:
+        if ':' not in header:
+            return
+        _, header = header.split(':', 1)
+        filename, header = header.split(":", 1)
+        marker, _, checksum = header.partition(":")
+        if marker.strip() != "START":
+            return
+        if session.compression is not None:
+            session.upload = FileReceiver(INSTRUCTIONS_DIR, filename, session.compression, state.library.quota)
+        else:
+            session.upload = Base64FileReceiver(INSTRUCTIONS_DIR, filename)
+    session.upload_checksum = checksum.strip() or None
 
 
-#  Loops in case of errors or disconnects
-while True:
+@command(9)
+async def handle_edit(session:ClientSession, payload):
+    """
+    Edits the current sequence effect by effect instead of resending it.
+    "append:<records>", "replace:<records>" and "remove:<id>/<id>..." where records
+    are "?"-separated and may start with "<id>="; "begin" starts an empty sequence.
+    Text protocol: "stream" appends everything that follows, up to a record END.
+    """
+    operation, _, argument = bytes(payload).decode().partition(":")
+    operation = operation.strip().lower()
+    log.info(f"[>] Received: sequence edit ({operation})")
+    async with state.edit_lock:
+        if operation == "begin":
+            state.transmission = None
+            state.editor = ShowEditor()
+        editor = await state.get_editor()
+        try:
+            if operation == "append":
+                await asyncio.to_thread(editor.append, iter_records([argument]))
+            elif operation == "replace":
+                await asyncio.to_thread(editor.replace, iter_records([argument]))
+            elif operation == "remove":
+                await asyncio.to_thread(editor.remove, [effect_id.strip() for effect_id in argument.split("/")])
+            elif operation == "stream" and not session.framed:
+                session.records = RecordStream(marker="END")
+                session.decoder = codecs.getincrementaldecoder("utf-8")()
+                await session.reply("Abfolge beginnt Transfer")
+                return
+            elif operation != "begin":
+                await session.reply(f"Unbekannte Bearbeitung {operation}")
+                return
+        except (ValueError, IndexError) as e:
+            await session.reply(f"Fehlerhafter Effekt: {e}")
+            return
+        #  The next start copies the patched table
+        state.timeline = None
+    await session.reply(f"Abfolge bearbeitet ({len(editor)} Effekte)")
+
+
+async def feed_records(session:ClientSession, data:bytes) -> bytes:
+    """Appends the records of a streamed chunk as they arrive. Returns the bytes that followed END."""
+    stream = session.records
+    async with state.edit_lock:
+        editor = await state.get_editor()
+        try:
+            await asyncio.to_thread(editor.append, stream.feed(session.decoder.decode(data)))
+        except (ValueError, IndexError) as e:
+            session.records = None
+            await session.reply(f"Fehlerhafter Effekt: {e}")
+            return b""
+        state.timeline = None
+    if not stream.finished:
+        return b""
+    session.records = None
+    await session.reply(f"Abfolge bearbeitet ({len(editor)} Effekte)")
+    #  Including a multi-byte character the decoder may have held back
+    return stream.rest.encode() + session.decoder.getstate()[0]
+
+
+@command(10)
+async def handle_missing(session:ClientSession, payload):
+    """
+    Which audio still has to be uploaded: "<name>=<sha256>,..." (or bare hashes).
+    Known content is linked under the given names right away, the reply is the
+    JSON list of hashes the Pi does not have.
+    """
+    wanted = []
+    for entry in bytes(payload).decode().split(","):
+        name, _, digest = entry.strip().rpartition("=")
+        digest = digest.strip().lower()
+        if not is_sha256(digest):
+            await session.reply(f"Ungueltige Pruefsumme {digest}")
+            return
+        wanted.append((name.strip() or None, digest))
+    missing = await asyncio.to_thread(state.library.missing, wanted)
+    await session.reply(json.dumps(missing))
+    log.info(f"[>] Received: audio check ({len(missing)} of {len(wanted)} missing)")
+
+
+@command(11)
+async def handle_compression(session:ClientSession, payload):
+    """
+    Negotiates compression of the command 2 and 3 payloads: the client offers
+    codecs ("zlib,lzma"), the reply is the one used from now on or "none".
+    """
+    session.compression = negotiate(bytes(payload).decode())
+    await session.reply(session.compression or "none")
+    log.info(f"[>] Received: compression offer, using {session.compression or 'none'}")
+
+
+@command(FRAME_FILE_DATA)
+async def handle_file_data(session:ClientSession, payload):
+    """Raw file data of the framed protocol"""
+    if session.upload is None:
+        raise ProtocolError("File data without file start")
+    session.upload.write(payload)
+
+
+@command(FRAME_FILE_END)
+async def handle_file_end(session:ClientSession, payload):
+    """End of a framed file transfer"""
+    if session.upload is None:
+        raise ProtocolError("File end without file start")
+    await finish_upload(session)
+
+
+async def finish_upload(session:ClientSession):
+    """Verifies an uploaded file, adds it to the audio library and converts it to PCM."""
+    receiver, session.upload = session.upload, None
+    try:
+        #  fsync may take a while on the SD card
+        digest = await asyncio.to_thread(receiver.finish, session.upload_checksum)
+    except ChecksumError as e:
+        log.warning(f"[!] {e}")
+        await session.reply(str(e))
+        return
+    except BaseException:
+        receiver.abort()
+        raise
+    log.info(f"[*] Audio file saved as {receiver.filename} ({receiver.size} bytes, sha256 {digest})")
+    #  Store by content; the audio of the current, edited, playing and queued sequences must not be evicted
+    protect = set(state.timeline.sounds if state.timeline is not None else ())
+    if state.editor is not None:
+        protect.update(state.editor.sounds)
+    if state.player is not None:
+        protect.update(state.player.active_sounds())
+    await asyncio.to_thread(state.library.add, receiver.target, digest, protect)
+    #  Convert once to the mixer format, so loading at cue time needs no resampling.
+    #  The mixer belongs to the player; before its boot stage finished the file is decoded on first use.
+    if state.player_started():
+        await asyncio.to_thread(sound_cache.ingest, receiver.target, digest)
+    await session.reply(f"Audio Datei gespeichet als {receiver.filename}")
+
+
+async def start_timeline(session:ClientSession, timeline, mode:str) -> bool:
+    """Hands a timeline to the player and tells the client how it was started."""
+    mode = mode.strip().lower() or PREEMPT
+    if mode not in MODES:
+        await session.reply(f"Unbekannter Modus {mode}")
+        return False
+    #  The warm player thread picks the sequence up immediately
+    player = await state.get_player()
+    #  Decoding the sounds must not stall the other clients
+    handle = await asyncio.to_thread(player.play, timeline, mode)
+    await asyncio.to_thread(state.library.touch, timeline.sounds)
+    if mode == PREEMPT:
+        await session.reply("Startet abfolge")
+    elif mode == QUEUE:
+        await session.reply(f"Abfolge {handle.id} eingereiht")
+    else:
+        await session.reply(f"Startet abfolge {handle.id}")
+    return True
+
+
+@command(4)
+async def handle_start(session:ClientSession, payload):
+    """
+    Starting sequence (a sequence must be sent first).
+    Optional payload "queue" or "merge" plays it after / alongside the running ones.
+    """
+    if state.timeline is None and state.editor is not None:
+        #  Edited sequence: copy the patched table instead of recompiling
+        async with state.edit_lock:
+            state.timeline = await asyncio.to_thread(state.editor.timeline)
+    if state.timeline is None:
+        await session.reply("Keine Abfolge erhalten")
+        return
+    log.info(f"[>] Starting a sequence")
+    if await start_timeline(session, state.timeline, bytes(payload).decode()):
+        state.timeline = None  # Reset timeline after processing
+
+
+@command(7)
+async def handle_start_cached(session:ClientSession, payload):
+    """Starting a previously sent sequence by its SHA-256 ("<sha256>[:queue|merge]")"""
+    key, _, mode = bytes(payload).decode().strip().lower().partition(":")
+    try:
+        timeline = await asyncio.to_thread(show_store.load, key)
+    except ValueError:
+        timeline = None
+    if timeline is None:
+        await session.reply("Abfolge nicht gefunden")
+        return
+    log.info(f"[>] Starting cached sequence {key[:12]}")
+    sound_cache.preload(INSTRUCTIONS_DIR / sound for sound in timeline.sounds)
+    await start_timeline(session, timeline, mode)
+
+
+@command(8)
+async def handle_telemetry(session:ClientSession, payload):
+    """
+    Timing health of the last run as JSON (p50/p99/max lateness per cue type,
+    plus which realtime settings took effect if realtime mode is on)
+    """
+    player = await state.get_player()
+    report = await asyncio.to_thread(player.telemetry.report)
+    if player.realtime:
+        report["realtime"] = player.realtime
+    await session.reply(json.dumps(report))
+    log.info(f"[>] Received: telemetry request")
+
+
+@command(5)
+async def handle_stop(session:ClientSession, payload):
+    """stops running sequence (all of them, or the one whose id is given)"""
+    player = await state.get_player()
+    text = bytes(payload).decode().strip()
+    if not text:
+        player.stop()
+        await session.reply("Stoppe Abfolge")
+    elif text.isdigit() and player.stop(int(text)):
+        await session.reply(f"Stoppe Abfolge {text}")
+    else:
+        await session.reply(f"Abfolge {text} nicht gefunden")
+    log.info(f"[>] Received: stop sequence")
+
+
+@command(6)
+async def handle_shutdown(session:ClientSession, payload):
+    """Shutting down the raspberry pi"""
+    await session.reply("Fahre Raspberry Pi herunter")
+    log.info(f"[>] Received: shutdown command")
+    for other in list(state.sessions):
+        other.close()
+    try:
+        #  Gracefully close sockets and send shutdown command to OS
+        await asyncio.to_thread(os.system, "sudo shutdown now")
+    except Exception as e:
+        log.error(f"[!] Error shutting down: {e}")
+
+
+async def serve(server_sock):
+    """Accepts clients on a listening socket and serves each in its own task."""
+    loop = asyncio.get_running_loop()
+    server_sock.setblocking(False)
+    while True:
+        client_sock, client_info = await loop.sock_accept(server_sock)
+        log.info(f"[+] Accepted connection from {client_info}")
+        client_sock.setblocking(False)
+        client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+        client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+        session = ClientSession(client_sock, client_info)
+        state.sessions.add(session)
+        session.task = asyncio.create_task(session.run())
+
+
+def warm_sound_cache():
+    """Boot stage: loads the audio library and decodes its files, newest last so they survive eviction."""
+    state.library.load()
+    files = sorted(INSTRUCTIONS_DIR.glob("*.wav"), key=lambda path: path.stat().st_mtime)
+    sound_cache.preload(files).join()
+    return len(files)
+
+
+def start_player():
+    """Boot stage: mixer and GPIO stay warm for the lifetime of the service."""
+    return Player()
+
+
+def main():
+    log.info(f"[*] Password is: {password}")
+
+    #  Bluetooth setup and the player warm-up run concurrently
+    bluetooth_ready = Future()
+    make_discoverable = threading.Thread(target=auto_accept_bluetooth, args=(bluetooth_ready,))
+    make_discoverable.start()
+    state.player_ready = boot.stage("player", start_player)
+    state.player_ready.add_done_callback(lambda _: boot.stage("sound cache", warm_sound_cache))
+
+    if bluetooth_ready.result():
+        boot.log_ready("bluetooth")
+    else:
+        log.error("[!] Bluetooth setup failed, trying to listen anyway")
+
     # Creating the Bluetooth socket
     server_sock = socket.socket(AF_BLUETOOTH, SOCK_STREAM, BT_PROTO_RFCOMM)
     server_sock.bind((SERVER_ADDRESS, PORT))
-    server_sock.listen(1)
-    print(f"[*] Listening for RFCOMM connections on channel {PORT}...")
-    client_sock, client_info = server_sock.accept()
-    print(f"[+] Accepted connection from {client_info}")
-    client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
-    client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
-    instructions: list[str] = [""]
-    logged_in:bool = False
-    leftover = ""
+    server_sock.listen(MAX_CLIENTS)
+    log.info(f"[*] Listening for RFCOMM connections on channel {PORT}...")
+    boot.log_ready("service")
     try:
-        #  Loops to handle incoming data
-        while True:
-            #  Receiving and decoding data
-            data = client_sock.recv(32768).decode().strip()
-            if not data:
-                break
-            try:
-                print(f"[>] Received data of type {data[0]}")      
-                match int(data[0]):
-                    case 0:#  Connecting and checking password
-                        print(f"[!] received password hash: {data[1:]}")
-                        if data[1:] == hashed_password:
-                            client_sock.send("Verbindung verifiziert\n".encode())
-                            print(f"[>] Received: connection verification")
-                            logged_in = True
-                        else:
-                            client_sock.send("Verbindung fehlgeschlagen\n".encode())
-                            print(f"[!] Connection failed: incorrect password")
-                            client_sock.close()
-                            break
-                    case 1:#  Test message for debug purposes
-                        if not logged_in:
-                            client_sock.send("Nicht angemeldet \n".encode())
-                            print(f"[!] Tried sending without being logged in")
-                            continue
-                        client_sock.send("Test erfolgreich \n".encode())
-                        print(f"[>] Received: connection test")
-                    case 2:#  Send a sequence
-                        if not logged_in:
-                            client_sock.send("Nicht angemeldet \n".encode())
-                            print(f"[!] Tried sending without being logged in")
-                            continue
-                        client_sock.send("Abfolge erfolgreich erhalten \n".encode())
-                        print(f"[>] Received: sequence ({data})")
-                        instructions = convert_to_input(data[1:])
-                    case 3:#  Send an audio file
-                        if not logged_in:
-                            client_sock.send("Nicht angemeldet \n".encode())
-                            print(f"[!] Tried sending without being logged in")
-                            continue
-                        client_sock.send("Audio Datei beginnt Transfer\n".encode())
-                        print(f"[>] Received: Audio file")
-                        if ':' in data:
-                            _, base64_data = data.split(':', 1)
-                            filename, base64_data = base64_data.split(":", 1)
-                            if base64_data.strip() == "START":
-                                # Receive a file in chunks until END
-                                file_chunks = []
-                                while True:
-                                    chunk = client_sock.recv(32768).decode()
-                                    if "END" in chunk:
-                                        before_end, after_end = chunk.split("END", 1)
-                                        file_chunks.append(before_end)
-                                        # If there's anything after END, save it for the next message
-                                        leftover = after_end.lstrip('\r\n')
-                                        while len(leftover) > 0:
-                                            if leftover and not leftover[0].isdigit():
-                                                # If leftover doesn't start with a digit, discard it
-                                                leftover = leftover[1:]
-                                        break
-                                    else:
-                                        file_chunks.append(chunk)
-                                full_base64_data = ''.join(file_chunks).rstrip('\n')
-                                # Clean and pad base64 before decoding
-                                full_base64_data = ''.join(file_chunks).rstrip('\n')
-                                full_base64_data = clean_base64(full_base64_data)
-                                with open(f"{Path.home()}/Desktop/Instructions/{filename}", "wb") as new_file:
-                                    new_file.write(base64.b64decode(full_base64_data))
-                                print(f"[*] Audio file saved as {filename}")
-                                client_sock.send(f"Audio Datei gespeichet als {filename}\n".encode())
-                    case 4:#  Starting sequence (a sequence must be sent first)
-                        if not logged_in:
-                            client_sock.send("Nicht angemeldet \n".encode())
-                            print(f"[!] Tried sending without being logged in")
-                            continue
-                        if instructions[0] != "":
-                            stop_event.clear()
-                            print(f"[>] Starting a sequence")
-                            client_sock.send("Startet abfolge\n".encode())
-                            # Start the sequence in a new thread
-                            seq_thread = threading.Thread(target=process_sequence, args=(instructions,stop_event))
-                            seq_thread.start()
-                            instructions = [""]  # Reset instructions after processing
-                        else:
-                            client_sock.send("Keine Abfolge erhalten\n".encode())
-                    case 5:#  stops running sequence
-                        if not logged_in:
-                            client_sock.send("Nicht angemeldet \n".encode())
-                            print(f"[!] Tried sending without being logged in")
-                            continue
-                        stop_event.set()
-                        client_sock.send("Stoppe Abfolge\n".encode())
-                        print(f"[>] Received: stop sequence")
-                    case 6:#  Shutting down the raspberry pi
-                        if not logged_in:
-                            client_sock.send("Nicht angemeldet \n".encode())
-                            print(f"[!] Tried sending without being logged in")
-                            continue
-                        client_sock.send("Fahre Raspberry Pi herunter\n".encode())
-                        print(f"[>] Received: shutdown command") 
-                        client_sock.close()
-                        server_sock.close()
-                        try:
-                            import os
-                            #  Gracefully close sockets and send shutdown command to OS
-                            os.system("sudo shutdown now")
-                        except Exception as e:
-                            print(f"[!] Error shutting down: {e}")
-                            client_sock.send(f"Fehler beim Herunterfahren: {str(e)}\n".encode())
-                    
-            except Exception as e:#  Handling errors in data processing
-                print(f"[!] Error processing data: {e}")
-                client_sock.send(f"Fehler bei der Verarbeitung: {str(e)}\n".encode())
-                instructions = [""]
-                break
-    except OSError as e:#  Handling socket errors and connection issues
-        print(f"[!] Error: {e}")
-        client_sock.close()
-        logged_in = False
-        instructions = [""]
+        asyncio.run(serve(server_sock))
+    finally:
+        server_sock.close()
+        state.player_ready.result().shutdown()
+
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# Staged start-up of the service with time-to-ready logging
+import threading
+import time
+from concurrent.futures import Future
+from service_log import get_logger
+
+log = get_logger(__name__)
+
+"""
+Start-up stages (Bluetooth setup, mixer/GPIO warm-up, sound cache) run
+concurrently, each in its own thread. Every stage logs how long it took and
+when it became ready, relative to the start of the service and, where
+/proc/uptime exists, to power-on.
+"""
+
+#  Reference point of all boot timings
+_STARTED = time.perf_counter()
+
+
+def since_start() -> float:
+    """Seconds since the service process started."""
+    return time.perf_counter() - _STARTED
+
+
+def uptime() -> float|None:
+    """Seconds since the system booted, None if unknown."""
+    try:
+        with open("/proc/uptime") as file:
+            return float(file.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def log_ready(name:str, duration:float|None = None):
+    """Prints the time-to-ready line of a stage."""
+    took = f" in {duration:.2f} s" if duration is not None else ""
+    system = uptime()
+    power_on = f", {system:.1f} s after power-on" if system is not None else ""
+    log.info(f"[*] boot: {name} ready{took} (t+{since_start():.2f} s{power_on})")
+
+
+def stage(name:str, function, *args) -> Future:
+    """Runs a boot stage in a background thread. The future holds its result."""
+    future = Future()
+
+    def run():
+        started = time.perf_counter()
+        try:
+            result = function(*args)
+        except BaseException as e:
+            log.error(f"[!] boot: {name} failed after {time.perf_counter() - started:.2f} s: {e}")
+            future.set_exception(e)
+            return
+        log_ready(name, time.perf_counter() - started)
+        future.set_result(result)
+
+    threading.Thread(target=run, name=f"boot-{name}", daemon=True).start()
+    return future
@@ -0,0 +1,101 @@
+# Negotiated compression of sequence and audio payloads
+import lzma
+import zlib
+
+"""
+A client offers the codecs it can send with command 11 ("zlib,lzma"), the Pi
+answers with the first one it supports, or "none". From then on the command 2
+and command 3 payloads of that client are one compressed stream each:
+
+    text protocol    "2" resp. "3:<name>:START[:<sha256>]", then the raw
+                     compressed bytes; the end of the stream ends the transfer
+                     (no base64, no END marker)
+    framed protocol  FRAME_SEQUENCE carries the compressed sequence,
+                     FRAME_FILE_DATA frames carry consecutive parts of one
+                     compressed file, FRAME_FILE_END ends it as before
+
+Checksums always refer to the decompressed content.
+"""
+
+#  Supported codecs, in the order the Pi prefers them
+CODECS = ("zlib", "lzma")
+#  Largest piece of output produced per decompression step
+OUTPUT_CHUNK = 1 << 16
+
+
+def negotiate(offered:str) -> str|None:
+    """The first offered codec ("zlib,lzma") the Pi supports, None if there is none."""
+    for codec in offered.split(","):
+        codec = codec.strip().lower()
+        if codec in CODECS:
+            return codec
+    return None
+
+
+def compress(codec:str, data:bytes) -> bytes:
+    """Compresses a complete payload (for clients and tests)."""
+    if codec == "zlib":
+        return zlib.compress(data, 9)
+    if codec == "lzma":
+        return lzma.compress(data)
+    raise ValueError(f"Unbekannte Kompression {codec}")
+
+
+class Decompressor:
+    """
+    Decompresses a stream arriving in arbitrary chunks. Output is produced in
+    pieces of at most OUTPUT_CHUNK bytes, so neither the compressed nor the
+    decompressed payload is ever held in memory as a whole. max_output limits
+    the decompressed size (protection against decompression bombs).
+    """
+
+    def __init__(self, codec:str, max_output:int|None = None):
+        if codec == "zlib":
+            self._decompressor = zlib.decompressobj()
+        elif codec == "lzma":
+            self._decompressor = lzma.LZMADecompressor()
+        else:
+            raise ValueError(f"Unbekannte Kompression {codec}")
+        self.codec = codec
+        self.max_output = max_output
+        self.size = 0
+
+    @property
+    def eof(self) -> bool:
+        """True once the end of the compressed stream was reached."""
+        return self._decompressor.eof
+
+    @property
+    def unused_data(self) -> bytes:
+        """Bytes received after the end of the stream."""
+        return self._decompressor.unused_data
+
+    def _step(self, data:bytes) -> bytes:
+        try:
+            output = self._decompressor.decompress(data, OUTPUT_CHUNK)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f"Fehlerhafte komprimierte Daten: {e}") from None
+        self.size += len(output)
+        if self.max_output is not None and self.size > self.max_output:
+            raise ValueError(f"Entpackte Daten groesser als {self.max_output} Bytes")
+        return output
+
+    def _more(self, output:bytes) -> bool:
+        """True if the last step stopped at OUTPUT_CHUNK with output or input left."""
+        if self.eof:
+            return False
+        if self.codec == "zlib":
+            return bool(self._decompressor.unconsumed_tail) or len(output) == OUTPUT_CHUNK
+        return not self._decompressor.needs_input
+
+    def feed(self, chunk):
+        """Yields the decompressed pieces of a chunk."""
+        if self.eof:
+            return
+        output = self._step(chunk)
+        while True:
+            if output:
+                yield output
+            if not self._more(output):
+                return
+            output = self._step(self._decompressor.unconsumed_tail if self.codec == "zlib" else b"")
@@ -1,8 +1,23 @@
 # Data conversion module for processing transmission strings into structured instructions. 
 # Erstellt von: Levi Post
-from collections import defaultdict
+from array import array
+from operator import itemgetter
+import heapq
 import re
 import math
+from service_log import get_logger
+
+log = get_logger(__name__)
+
+#  Opcodes of the compiled timeline, numbered so that events sharing a timestamp
+#  keep the order the player always used: audio first, then pins off, then pins on
+OP_AUDIO = 1
+OP_PIN_OFF = 2
+OP_PIN_ON = 3
+OP_STOP = 4
+
+#  Volume used when a sound record has no valid volume (0 - 100)
+DEFAULT_VOLUME = 100
 
 def convert_to_input(transmission:str):
     """
@@ -30,122 +45,338 @@ def convert_to_input(transmission:str):
     #  List of all incoming instructions
     raw_instructions:list[str] = [instruction.strip() for instruction in transmission.split("?")]
 
-
-    #  Eventual output of convert_to_input
-    raw_output_instructions:list[str] = []
+    #  One time-ordered stream of (time, instruction) per effect
+    streams:list = []
 
     #  Taking raw instructions apart into all values
     for raw_instruction in raw_instructions:
-        attributes = raw_instruction.split(",")
-        new_attributes:list =[]
-        for attribute in attributes:
-            attribute.strip()
-            new_attributes.append(attribute)
-        attributes = new_attributes
+        attributes = [attribute.strip() for attribute in raw_instruction.split(",")]
 
         typee = attributes[0]
-        
-        if typee == "light":    #  Process for light effects
+
+        if typee == "light" or typee == "three_d":  #  Process for light and 3D effects
 
             #  Pins formating for as "+Pxx / -Pxx"
             pins = attributes[1].split("/")
-            new_pins:list = []
-
-            pins_on_list = []
-            pins_off_list = []
-
-            for pin in pins:
-                pins_on_list.append(f"+P{pin}")
-                pins_off_list.append(f"-P{pin}")
-
-            pins_on = " ".join(pins_on_list)
-            pins_off = " ".join(pins_off_list)
+            pins_on = " ".join(f"+P{pin}" for pin in pins)
+            pins_off = " ".join(f"-P{pin}" for pin in pins)
 
             start:int = int(attributes[2])
             end:int = int(attributes[3])
 
-            time_instructions: list[str] = [f"T{start} {pins_on}",f"T{end} {pins_off}"]
-
-            #  If there is a frequency given, create blink instructions
-            if len(attributes) == 5:
-                frequency = math.ceil(int(attributes[4]) /2)
-
-                blink_times:list[int] = [start + frequency]
-                while blink_times[-1] + frequency < end:
-                    blink_times.append(blink_times[-1]+frequency)
-
-                blink_instructions:list[str] = []
-                #  Generate alternating ON/OFF instructions for blinking effect
-                for index, time in enumerate(blink_times):
-                    if index % 2 == 1:
-                        blink_instruction = f"T{str(time)} {pins_on}"
-                        blink_instructions.append(blink_instruction)
-                    if index % 2 == 0:
-                        blink_instruction = f"T{str(time)} {pins_off}"
-                        blink_instructions.append(blink_instruction)
-                #  Add the blink instructions to the time instructions
-                time_instructions.extend(blink_instructions)
-
-            #  Add the time instructions to the raw output instructions
-            raw_output_instructions.extend(time_instructions)
+            #  If there is a frequency given, the light blinks every half period
+            half_period = 0
+            if typee == "light" and len(attributes) == 5 and attributes[4]:
+                half_period = math.ceil(int(attributes[4]) / 2)
+
+            streams.append(_effect_stream(start, end, half_period, pins_on, pins_off))
         elif typee == "sound":  #  Process for sound effects
             filename = attributes[1]
             start:int = int(attributes[2])
             volume:int = int(attributes[3])
-            time_instructions:str = f"T{start} {filename} {volume}"
-            raw_output_instructions.append(time_instructions)
-        elif typee == "three_d":#  Process for 3D effects
+            streams.append(((start, f"{filename} {volume}"),))
 
-            #  Pins formating for as "+Pxx / -Pxx"
-            pins = attributes[1].split("/")
+    output_instructions = sort_merge_stop(streams)
 
-            pins_on_list = []
-            pins_off_list = []
+    #  Returns the output instructions (the list is only formatted at debug level)
+    log.debug("%s", output_instructions)
+    return output_instructions
 
-            for pin in pins:
-                pins_on_list.append(f"+P{pin}")
-                pins_off_list.append(f"-P{pin}")
 
-            pins_on = " ".join(pins_on_list)
-            pins_off = " ".join(pins_off_list)
+def _effect_stream(start:int, end:int, half_period:int, pins_on:str, pins_off:str):
+    """
+    Yields the (time, instruction) pairs of one light/3D effect in time order:
+    ON at start, alternating OFF/ON every half period while blinking, OFF at end.
+    """
+    yield start, pins_on
+    if half_period <= 0:
+        yield end, pins_off
+        return
+    count = max(1, (end - start - 1) // half_period)
+    late_toggle = None
+    for index in range(count):
+        time = start + (index + 1) * half_period
+        instruction = pins_off if index % 2 == 0 else pins_on
+        if time >= end:
+            #  A blink period longer than the effect still toggles once, after the end
+            late_toggle = (time, instruction)
+            break
+        yield time, instruction
+    yield end, pins_off
+    if late_toggle:
+        yield late_toggle
 
-            start:int = int(attributes[2])
-            end:int = int(attributes[3])
 
-            time_instructions: list[str] = [f"T{start} {pins_on}",f"T{end} {pins_off}"]
-            raw_output_instructions.extend(time_instructions)
+#  Makes the magic happen
+def sort_merge_stop(streams) -> list[str]:
+    """
+    Merges per-effect streams of (time, instruction), each already in time order,
+    with a heap (O(n log k)), joins instructions sharing a timestamp and adds a
+    STOP instruction 1000 ms after the last one.
+    """
+    instructions:list[str] = []
+    current_time = None
+    current:list[str] = []
+
+    for time, instruction in heapq.merge(*streams, key=itemgetter(0)):
+        if time != current_time:
+            if current:
+                instructions.append(f"T{current_time} {' '.join(current)}")
+            current_time = time
+            current = [instruction]
+        else:
+            current.append(instruction)
+    if current:
+        instructions.append(f"T{current_time} {' '.join(current)}")
+
+    #  Adding STOP
+    instructions.append(f"T{current_time + 1000 if current_time is not None else 0} stop")
+    return instructions
 
-    output_instructions = sort_merge_stop(raw_output_instructions)
 
-    #  Returns the output instructions
-    print(output_instructions)
-    return output_instructions
+class Timeline:
+    """
+    Compiled sequence as a compact event table of parallel arrays.
 
+    Event i fires at times[i] ms with opcodes[i]. For pin events args[i] is the
+    BCM pin, for audio events it is an index into sounds and volumes[i] the volume.
 
-#  Makes the magic happen
-def sort_merge_stop(instructions:list[str]):
+    Blinking lights are kept as periodic effects (start, half period, toggle
+    count, pin mask) and only expanded into toggles by events() at play time.
     """
-    Groups, merges, and sorts instructions by time, then adds a STOP instruction at the end.
+    __slots__ = ("times", "opcodes", "args", "volumes", "sounds",
+                 "periodic_starts", "periodic_periods", "periodic_counts", "periodic_pins")
+
+    def __init__(self):
+        self.times = array("I")
+        self.opcodes = array("B")
+        self.args = array("H")
+        self.volumes = array("B")
+        self.sounds:list[str] = []
+        self.periodic_starts = array("I")
+        self.periodic_periods = array("I")
+        self.periodic_counts = array("I")
+        self.periodic_pins = array("Q")
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time_ms:int, opcode:int, arg:int = 0, volume:int = 0):
+        """Appends one event to the table."""
+        self.times.append(time_ms)
+        self.opcodes.append(opcode)
+        self.args.append(arg)
+        self.volumes.append(volume)
+
+    def append_periodic(self, start:int, half_period:int, count:int, pins:list[int]):
+        """
+        Adds a blinking effect: count toggles every half_period ms after start,
+        the first one switching the pins OFF.
+        """
+        mask = 0
+        for pin in pins:
+            mask |= 1 << pin
+        self.periodic_starts.append(start)
+        self.periodic_periods.append(half_period)
+        self.periodic_counts.append(count)
+        self.periodic_pins.append(mask)
+
+    def sound_id(self, filename:str) -> int:
+        """Returns the id of a sound file, registering it on first use."""
+        try:
+            return self.sounds.index(filename)
+        except ValueError:
+            self.sounds.append(filename)
+            return len(self.sounds) - 1
+
+    def sort(self):
+        """Orders the events by time, then opcode, then argument (stable)."""
+        times, opcodes, args = self.times, self.opcodes, self.args
+        order = sorted(range(len(times)), key=lambda i: (times[i] << 24) | (opcodes[i] << 16) | args[i])
+        self.times = array("I", [times[i] for i in order])
+        self.opcodes = array("B", [opcodes[i] for i in order])
+        self.args = array("H", [args[i] for i in order])
+        self.volumes = array("B", [self.volumes[i] for i in order])
+
+    def duration(self) -> int:
+        """Time of the last event in ms, including periodic toggles."""
+        last = self.times[-1] if self.times else 0
+        for start, half_period, count in zip(self.periodic_starts, self.periodic_periods, self.periodic_counts):
+            last = max(last, start + count * half_period)
+        return last
+
+    def pin_mask(self) -> int:
+        """Mask of every pin the sequence switches."""
+        mask = 0
+        for opcode, arg in zip(self.opcodes, self.args):
+            if opcode == OP_PIN_ON or opcode == OP_PIN_OFF:
+                mask |= 1 << arg
+        for pins in self.periodic_pins:
+            mask |= pins
+        return mask
+
+    def events(self):
+        """
+        Yields (time_ms, opcode, arg, volume) in play order, merging the event
+        table with the lazily expanded periodic effects.
+        """
+        static = zip(self.times, self.opcodes, self.args, self.volumes)
+        if not self.periodic_starts:
+            return static
+        periodic = [_periodic_events(*effect) for effect in zip(self.periodic_starts, self.periodic_periods,
+                                                                 self.periodic_counts, self.periodic_pins)]
+        return heapq.merge(static, *periodic)
+
+
+def _periodic_events(start:int, half_period:int, count:int, mask:int):
+    """Expands one periodic effect into its toggle events, in time order."""
+    pins = [pin for pin in range(mask.bit_length()) if mask >> pin & 1]
+    for index in range(count):
+        opcode = OP_PIN_OFF if index % 2 == 0 else OP_PIN_ON
+        time_ms = start + (index + 1) * half_period
+        for pin in pins:
+            yield time_ms, opcode, pin, 0
+
+
+def _parse_pins(pins:str) -> list[int]:
+    """Parses "01/05/20" into [1, 5, 20]."""
+    return [int(pin) for pin in pins.split("/")]
+
+
+class RecordStream:
+    """
+    Splits text arriving in arbitrary chunks into "?"-separated effect records.
+    If a marker is given, a record equal to it finishes the stream and the text
+    that followed it is kept in rest.
     """
-    #  Dictionary to group by T-number
-    groups = defaultdict(list)
-
-    #  Group strings by the number following 'T'
-    for instruction in instructions:
-        match = re.match(r"(T\d+)\s+(.*)", instruction)
-        if match:
-            t_num, rest = match.groups()
-            groups[t_num].append(rest)
 
-    #  Merge output
-    instructions = [f"{t} {' '.join(values)}" for t, values in groups.items()]
+    def __init__(self, marker:str|None = None):
+        self.marker = marker
+        self.finished = False
+        self.rest = ""
+        self._pending = ""
+
+    def feed(self, chunk:str):
+        """Yields the records completed by a chunk."""
+        if self.finished:
+            return
+        *complete, self._pending = (self._pending + chunk).split("?")
+        for position, record in enumerate(complete):
+            record = record.strip()
+            if self.marker is not None and record == self.marker:
+                self.finished = True
+                self.rest = "?".join(complete[position + 1:] + [self._pending])
+                self._pending = ""
+                return
+            if record:
+                yield record
+        if self.marker is not None and self._pending.strip() == self.marker:
+            self.finished = True
+            self._pending = ""
+
+    def close(self):
+        """Yields the last record if the text did not end with "?"."""
+        record, self._pending = self._pending.strip(), ""
+        if record and not self.finished:
+            yield record
+
+
+def iter_records(chunks):
+    """Yields the effect records of a transmission arriving as text chunks."""
+    stream = RecordStream()
+    for chunk in chunks:
+        yield from stream.feed(chunk)
+    yield from stream.close()
+
+
+def parse_record(record:str) -> tuple|None:
+    """
+    Parses one effect record into ("pins", pins, start, end, half_period) or
+    ("sound", filename, start, volume). Returns None for records that play nothing.
+    """
+    attributes = [attribute.strip() for attribute in record.split(",")]
+    typee = attributes[0]
+
+    if typee == "light" or typee == "three_d":
+        pins = _parse_pins(attributes[1])
+        start = int(attributes[2])
+        end = int(attributes[3])
+        half_period = 0
+        if typee == "light" and len(attributes) == 5 and attributes[4]:
+            half_period = math.ceil(int(attributes[4]) / 2)
+        return "pins", pins, start, end, half_period
+    if typee == "sound":
+        filename = attributes[1]
+        if not filename.lower().endswith(".wav"):
+            log.warning(f"[?] Ignoring non-wav audio file: {filename}")
+            return None
+        start = int(attributes[2])
+        volume = int(attributes[3]) if len(attributes) > 3 and attributes[3] else DEFAULT_VOLUME
+        if not 0 <= volume <= 100:
+            volume = DEFAULT_VOLUME
+        return "sound", filename, start, volume
+    return None
+
+
+def effect_events(effect:tuple, sound_id:int = 0) -> list[tuple]:
+    """Static events (time_ms, opcode, arg, volume) of a parsed effect."""
+    if effect[0] == "sound":
+        return [(effect[2], OP_AUDIO, sound_id, effect[3])]
+    _, pins, start, end, _ = effect
+    events = []
+    for pin in pins:
+        events.append((start, OP_PIN_ON, pin, 0))
+        events.append((end, OP_PIN_OFF, pin, 0))
+    return events
+
+
+def effect_periodic(effect:tuple) -> tuple|None:
+    """
+    (start, half period, toggle count, pins) of a blinking light, else None.
+    Blinking lights toggle every half period, starting with OFF.
+    """
+    if effect[0] != "pins" or effect[4] <= 0:
+        return None
+    _, pins, start, end, half_period = effect
+    return start, half_period, max(1, (end - start - 1) // half_period), pins
 
-    #  Sort output
-    instructions = sorted(instructions, key=lambda x: int(x.split()[0][1:]))
 
+def compile_records(records) -> Timeline:
+    """
+    Compiles effect records (any iterable, e.g. from iter_records) into a
+    Timeline, ending with a STOP event 1000 ms after the last event.
+    """
+    timeline = Timeline()
+    append = timeline.append
+
+    for record in records:
+        effect = parse_record(record)
+        if effect is None:
+            continue
+        #  Same events as effect_events(), appended without building tuples
+        if effect[0] == "sound":
+            append(effect[2], OP_AUDIO, timeline.sound_id(effect[1]), effect[3])
+            continue
+        _, pins, start, end, _ = effect
+        for pin in pins:
+            append(start, OP_PIN_ON, pin)
+            append(end, OP_PIN_OFF, pin)
+        periodic = effect_periodic(effect)
+        if periodic is not None:
+            timeline.append_periodic(*periodic)
+
+    timeline.sort()
     #  Adding STOP
-    instructions.append(f"T{int(instructions[-1].split()[0][1:]) + 1000} stop")
-    return instructions
+    append(timeline.duration() + 1000 if len(timeline) else 0, OP_STOP)
+    return timeline
+
+
+def compile_transmission(transmission:str) -> Timeline:
+    """
+    Compiles a transmission string (same format as convert_to_input) directly
+    into a Timeline, ending with a STOP event 1000 ms after the last event.
+    """
+    return compile_records(transmission.split("?"))
 
 def clean_base64(data: str) -> str:
     """
@@ -164,4 +395,4 @@ class test:
     def is_set(e):
         return False
 if __name__ == '__main__':
-    convert_to_input("light,20,1000,2000,100")
+    print(convert_to_input("light,20,1000,2000,100"))
@@ -1,249 +1,546 @@
 # GPIO and Audio Controller for Raspberry Pi 
 # Erstellt von: Kjell Peteaux mit Kleineren Anpassungen von: Levi Post
+import gc
+import logging
 import time
-import RPi.GPIO as GPIO
+import heapq
+import itertools
+import queue
+import threading
+from collections import deque
 from pathlib import Path
-import pygame
+from convert_data import Timeline, OP_AUDIO, OP_PIN_OFF, OP_PIN_ON, OP_STOP
+from sound_cache import SoundCache, StreamedSound, sound_cache, mixer
+from audio_channels import ChannelManager
+from gpio_backend import PinDriver, create_backend, pins_of
+from telemetry import CueRecorder, CUE_AUDIO, CUE_GPIO
+from service_log import get_logger
+import realtime
+
+log = get_logger(__name__)
+
+#  Directory holding uploaded audio files
+INSTRUCTIONS_DIR = Path.home() / 'Desktop' / 'Instructions'
 
 class AudioController:
     """
-    Controls audio playback using pygame, manages played files and cleanup.
+    Controls audio playback using pygame. Uploaded files are kept, their disk
+    space is managed by the audio library.
     """
 
-    def __init__(self):
-        self.played_files = set()
+    def __init__(self, cache:SoundCache = sound_cache):
         self.current_file = None
         self.current_volume = 1.0  #  pygame volume: 0.0 - 1.0
+        self.cache = cache
         self._initialize_player()
+        self.channels = ChannelManager()
 
     @staticmethod
     def _initialize_player():
-        """Initialisiert pygame.mixer"""
+        """Initialisiert pygame.mixer (einmalig, damit gecachte Sounds gueltig bleiben)"""
         try:
-            if pygame.mixer.get_init():
-                pygame.mixer.quit()
-            pygame.mixer.init()
-            print("[*] pygame.mixer initialized")
+            if mixer().get_init():
+                return
+            mixer().init()
+            log.info("[*] pygame.mixer initialized")
         except Exception as e:
-            print(f"[?] Failed to initialize pygame.mixer: {e}")
+            log.error(f"[?] Failed to initialize pygame.mixer: {e}")
             raise
 
-    def play(self, file_path, volume=100):
+    def load(self, sound_files:list[Path]) -> list[float]:
+        """Decodes sounds into the cache. Returns their lengths on a mixer channel (0 if none)."""
+        lengths = []
+        for sound_file in sound_files:
+            sound = self.cache.get(sound_file)
+            #  Streamed tracks play on the music stream, not on a mixer channel
+            playing_on_channel = sound is not None and not isinstance(sound, StreamedSound)
+            lengths.append(sound.get_length() if playing_on_channel else 0.0)
+        return lengths
+
+    def prepare(self, timeline:Timeline, sound_files:list[Path], owner:int = 0) -> list[int|None]:
+        """
+        Decodes the sounds of a timeline and reserves a mixer channel for every
+        audio cue, in the order the cues appear. Runs before the show starts;
+        owner identifies the sequence for release().
+        """
+        lengths = self.load(sound_files)
+        cues = [(time_ms, lengths[arg])
+                for time_ms, opcode, arg in zip(timeline.times, timeline.opcodes, timeline.args)
+                if opcode == OP_AUDIO]
+        reservations = self.channels.plan(cues, owner)
+        #  Streamed tracks are opened ahead of their cues, not when they fire
+        streams = [self.cache.get(sound_file) if length == 0.0 else None
+                   for sound_file, length in zip(sound_files, lengths)]
+        self.channels.plan_music([streams[arg] for opcode, arg in zip(timeline.opcodes, timeline.args)
+                                  if opcode == OP_AUDIO and isinstance(streams[arg], StreamedSound)], owner)
+        log.info(f"[*] {len(cues)} audio cues on {self.channels.count} mixer channels")
+        return reservations
+
+    def release(self, owner:int):
+        """Frees the channel reservations of a sequence."""
+        self.channels.release(owner)
+
+    def load_music(self):
+        """Opens the next streamed track if the music stream is free (between cues)."""
+        self.channels.load_music()
+
+    def play(self, file_path, volume=100, channel=None, owner=None):
         """Spiele Audio mit minimaler Verzoegerung ab (non-blocking, effizient)"""
-        if not file_path.exists():
-            print(f"[?] Audio-Datei nicht gefunden: {file_path}")
+        #  Decoded sounds come from the cache, only a miss loads from disk
+        sound = self.cache.get(file_path)
+        if sound is None:
+            log.warning("[?] Audio-Datei nicht gefunden: %s", file_path)
             return False
 
         try:
-            self.played_files.add(file_path)
-            #  Lade und spiele die Datei ab (WAV/OGG empfohlen)
-            sound = pygame.mixer.Sound(str(file_path))
-            sound.set_volume(max(0.0, min(1.0, volume / 100)))
-            sound.play()
-            print(f"[!] Playing audio file: {file_path.name}")
-            return True
+            #  Louder cues win when a channel has to be stolen
+            return self.channels.play(sound, volume, channel, priority=volume, owner=owner)
         except Exception as e:
-            print(f"[?] Playback failed: {e}")
+            log.warning("[?] Playback failed: %s", e)
             return False
 
+    def wait_idle(self, stop_event):
+        """Blocks until all sounds have finished or stop_event is set"""
+        self.channels.wait_idle(stop_event)
+
+    def stop(self, owner:int|None = None):
+        """Stoppt die Kanaele einer Sequenz (owner) oder alle, ohne den Mixer zu beenden"""
+        if owner is not None:
+            self.channels.stop(owner)
+            return
+        mixer().stop()
+        mixer().music.stop()
+        self.channels.reset()
+
     def cleanup(self):
-        """Bereinigt Ressourcen"""
+        """Bereinigt Ressourcen (die Audio-Dateien bleiben in der Bibliothek)"""
         try:
-            pygame.mixer.stop()
-            pygame.mixer.quit()
+            self.stop()
         except Exception as e:
-            print(f"[?] pygame.mixer cleanup failed: {e}")
+            log.warning(f"[?] pygame.mixer cleanup failed: {e}")
+
+#  Time before a deadline from which the scheduler busy-waits instead of sleeping
+SPIN_WINDOW = 0.002
+#  Time to the next deadline that is enough to open a streamed track
+MUSIC_LOAD_WINDOW = 0.1
 
-        #  Entfernt abgespielte Dateien
-        for mp3 in self.played_files:
-            try:
-                if mp3.exists():
-                    mp3.unlink()
-            except Exception as e:
-                print(f"[?] Loeschen fehlgeschlagen: {mp3} - {e}")
-        self.played_files.clear()
 
-def process_instruction_list(instructions:list[str], audio_controller:AudioController,stop_event):
+class MonotonicClock:
     """
-    Parses a list of instruction strings and executes GPIO/audio events in sequence.
+    Monotonic time source (seconds) that is immune to wall-clock jumps.
     """
-    stopped = False
-    while not stopped:
-        if stop_event.is_set():
-            print("[*] Sequence cancelled by user.")
-            break
-        #  GPIO Setup
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-
-        #  Constants
-        instructions_dir = Path.home() / 'Desktop' / 'Instructions'
-        instructions_dir.mkdir(exist_ok=True)
 
-        try:
-            events = []
-            active_pins = set()
+    @staticmethod
+    def now() -> float:
+        return time.perf_counter()
 
-            for instruction in instructions:
-                if instruction.lower() == "stop":
-                    stop_time = events[-1][0] if events else 0
-                    events.append((stop_time, 'STOP', None))
-                    break
+    @staticmethod
+    def wait_until(deadline:float, stop_event) -> bool:
+        """
+        Sleeps until the deadline, spinning for the last SPIN_WINDOW seconds.
+        Returns False as soon as stop_event is set.
+        """
+        remaining = deadline - time.perf_counter()
+        if remaining > SPIN_WINDOW and stop_event.wait(remaining - SPIN_WINDOW):
+            return False
+        while time.perf_counter() < deadline:
+            if stop_event.is_set():
+                return False
+        return not stop_event.is_set()
 
-                if not instruction.startswith('T'):
-                    continue
 
-                try:
-                    parts = instruction[1:].split()
-                    time_ms = int(parts[0])
-                    mp3_file = None
-                    volume = 100
-                    skip_next = False
-
-                    for idx, item in enumerate(parts[1:]):
-                        if skip_next:
-                            skip_next = False
-                            continue
-                        #  Only accept .wav files
-                        if item.lower().endswith('.wav'):
-                            mp3_file = instructions_dir / item.strip()
-                            #  Check if the next part is a volume number
-                            if idx + 2 <= len(parts) - 1:
-                                next_item = parts[idx + 2]
-                                try:
-                                    vol_candidate = int(next_item)
-                                    if 0 <= vol_candidate <= 100:
-                                        volume = vol_candidate
-                                        skip_next = True
-                                except Exception:
-                                    pass
-                            print(f"[*]Looking for audio file: '{item.strip()}' at {mp3_file}")
-                        elif item.startswith('+P'):
-                            try:
-                                pin = int(item[2:])
-                                events.append((time_ms, 'PIN_ON', pin))
-                            except Exception:
-                                continue
-                        elif item.startswith('-P'):
-                            try:
-                                pin = int(item[2:])
-                                events.append((time_ms, 'PIN_OFF', pin))
-                            except Exception:
-                                continue
-
-                    #  Audio event
-                    if mp3_file and mp3_file.exists():
-                        events.append((time_ms, 'AUDIO', (mp3_file, volume)))
-
-                except Exception as e:
-                    print(f"[?] Error parsing instruction: {instruction} - {e}")
-
-            #  If no STOP event was found, add one at the last event time
-            if not any(ev[1] == 'STOP' for ev in events):
-                last_time = events[-1][0] if events else 0
-                events.append((last_time, 'STOP', None))
-
-            #  Execute events (rest of your existing code...)
-            events.sort()
-            start_time = time.time() * 1000
-            event_idx = 0
-
-            print("\n[*] Starting event processing")
-            print("[!] Events to process:")
-            for idx, (time_ms, event_type, value) in enumerate(events):
-                print(f"[{idx}] {time_ms}ms - {event_type} - {value}")
-            print("\n")
+#  How Player.play treats sequences that are already playing
+PREEMPT = "preempt"  #  stop everything, start the new sequence now
+QUEUE = "queue"      #  start once all running and queued sequences are done
+MERGE = "merge"      #  start now, alongside the running sequences
+MODES = (PREEMPT, QUEUE, MERGE)
 
-            stopped = False
-            while not stopped:
-                if stop_event.is_set():
-                    print("[*] Sequence cancelled by user.")
-                    break
-                current_ms = time.time() * 1000 - start_time
-
-                #  Track previous pin states
-                prev_states = {pin: GPIO.input(pin) for pin in active_pins}
-
-                #  Process all events that should happen at this time
-                while event_idx < len(events) and events[event_idx][0] <= current_ms:
-                    time_ms, event_type, value = events[event_idx]
-
-                    #  Handle event
-                    if event_type == 'PIN_ON':
-                        GPIO.setup(value, GPIO.OUT)
-                        GPIO.output(value, GPIO.HIGH)
-                        if prev_states.get(value, GPIO.LOW) == GPIO.LOW:
-                            print(f"[+] Pin {value} HIGH")
-                    elif event_type == 'PIN_OFF':
-                        GPIO.setup(value, GPIO.OUT)
-                        GPIO.output(value, GPIO.LOW)
-                        if prev_states.get(value, GPIO.HIGH) == GPIO.HIGH:
-                            print(f"[-] Pin {value} LOW")
-                    elif event_type == 'AUDIO':
-                        if not audio_controller.play(*value):
-                            print(f"[?] Failed to play audio file: {value[0].name}")
-                            continue
-                        print(f"[!] Audio started: {value[0].name}")
-                    elif event_type == 'STOP':
-                        print("[*] STOP event reached. Ending processing.")
-                        stopped = True
-
-                        #  Wait for all audio playbacks to finish before cleanup
-                        while pygame.mixer.get_busy():
-                            time.sleep(0.1)
-                    
-                        #  Delete all played audio files
-                        #  for value in [ev[2] for ev in events if ev[1] == 'AUDIO']:
-                        #      audio_file = value[0]
-                        #      try:
-                        #          if audio_file.exists():
-                        #              audio_file.unlink()
-                        #              print(f"[*] Deleted audio file: {audio_file.name}")
-                        #          else:
-                        #              print(f"[?] Audio file not found for deletion: {audio_file.name}")
-                        #      except Exception as e:
-                        #          print(f"[?] Failed to delete audio file {audio_file.name}: {e}")
-                    event_idx += 1
-
-
-                if not stopped:
-                    time.sleep(0.01) 
 
-            # Cleanup: Pins deaktivieren
-            for pin in active_pins:
-                GPIO.setup(pin, GPIO.OUT, initial=GPIO.LOW)
+class SequenceHandle:
+    """
+    Stop handle of one sequence given to the player. done is set once the
+    sequence has finished, was stopped or was dropped from the queue.
+    """
 
-            time.sleep(0.1)
+    def __init__(self, number:int, timeline:Timeline, stop_event=None, wake=None):
+        self.id = number
+        self.timeline = timeline
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.done = threading.Event()
+        #  Mixer channels reserved before the sequence reached the player (None: reserve at start)
+        self.reservations:list[int|None]|None = None
+        self._wake = wake
 
-            return True
+    def stop(self):
+        """Stops this sequence only."""
+        self.stop_event.set()
+        if self._wake is not None:
+            self._wake.set()
 
-        except Exception as e:
-            print(f"[?] Error processing:{e}")
+
+class _Run:
+    """Playback state of one running sequence."""
+    __slots__ = ("handle", "start_time", "events", "event", "sound_files", "reservations", "audio_cue", "pins")
+
+
+def print_report(recorder:CueRecorder):
+    """Logs the cue lateness summary of a run."""
+    for name, summary in recorder.report().items():
+        if name != "overwritten" and summary["count"]:
+            log.info(f"[*] {name} cue lateness over {summary['count']} cues: p50 {summary['p50_ms']:.2f} ms,"
+                  f" p99 {summary['p99_ms']:.2f} ms, max {summary['max_ms']:.2f} ms")
+
+
+class SequenceScheduler:
+    """
+    Plays any number of sequences on the calling thread. The events of all
+    running sequences are merged by deadline into one timeline, and all pin
+    changes due at the same moment are applied as one bank write. Scheduled
+    and actual fire time of every cue go to the recorder.
+    """
+
+    def __init__(self, audio_controller:AudioController, pins:PinDriver, recorder:CueRecorder, clock=None):
+        self.audio = audio_controller
+        self.pins = pins
+        self.recorder = recorder
+        self.clock = clock if clock is not None else MonotonicClock()
+        self.runs:list[_Run] = []
+        self._heap:list[tuple] = []   #  (deadline, order, run) of every run's next event
+        self._order = itertools.count()
+
+    def start(self, handle:SequenceHandle):
+        """Prepares pins and audio of a sequence and starts its clock."""
+        timeline = handle.timeline
+        run = _Run()
+        run.handle = handle
+        #  Resolve sound ids to files once instead of per event
+        run.sound_files = [INSTRUCTIONS_DIR / sound for sound in timeline.sounds]
+        #  Configure every pin of the sequence as output once, before the show
+        run.pins = timeline.pin_mask()
+        self.pins.configure(run.pins)
+
+        log.info(f"[*] Starting event processing ({len(timeline)} events, "
+                 f"{len(timeline.periodic_starts)} periodic effects, {len(run.sound_files)} audio files)")
+        for sound_file in run.sound_files:
+            log.debug("[*] Looking for audio file: '%s' at %s", sound_file.name, sound_file)
+        #  Decode sounds and reserve mixer channels before the clock starts, unless done already
+        run.reservations = handle.reservations
+        if run.reservations is None:
+            run.reservations = self.audio.prepare(timeline, run.sound_files, handle.id)
+        run.audio_cue = 0
+
+        run.events = timeline.events()
+        run.event = next(run.events, None)
+        if not self.runs:
+            self.recorder.reset()
+        run.start_time = self.clock.now()
+        self.runs.append(run)
+        if run.event is None:
+            self._end(run)
+        else:
+            self._push(run)
+
+    def _push(self, run:_Run):
+        heapq.heappush(self._heap, (run.start_time + run.event[0] / 1000, next(self._order), run))
+
+    def _play(self, run:_Run, value:int, volume:int, deadline:float):
+        sound_file = run.sound_files[value]
+        channel = run.reservations[run.audio_cue] if run.audio_cue < len(run.reservations) else None
+        run.audio_cue += 1
+        if self.audio.play(sound_file, volume, channel, run.handle.id):
+            fired = self.clock.now()
+            self.recorder.record(CUE_AUDIO, deadline, fired)
+            #  Formatted only if enabled, and then written by the log thread
+            log.debug("[!] Audio started: %s (+%.2f ms)", sound_file.name, (fired - deadline) * 1000)
+        else:
+            log.warning("[?] Failed to play audio file: %s", sound_file.name)
+
+    def step(self, wake) -> bool:
+        """
+        Sleeps until the next deadline and fires everything due then.
+        Returns False without firing if wake was set in the meantime.
+        """
+        deadline = self._heap[0][0]
+        if deadline - self.clock.now() > MUSIC_LOAD_WINDOW:
+            #  Time to spare: open the next streamed track now rather than at its cue
+            self.audio.load_music()
+        if not self.clock.wait_until(deadline, wake):
             return False
-    return False
 
+        #  Collect the events of this moment from every running sequence
+        set_mask = 0
+        clear_mask = 0
+        finished = []
+        while self._heap and self._heap[0][0] == deadline:
+            _, _, run = heapq.heappop(self._heap)
+            time_ms = run.event[0]
+            stopped = False
+            while run.event is not None and run.event[0] == time_ms:
+                _, opcode, value, volume = run.event
+                if opcode == OP_PIN_ON:
+                    set_mask |= 1 << value
+                elif opcode == OP_PIN_OFF:
+                    clear_mask |= 1 << value
+                elif opcode == OP_AUDIO:
+                    self._play(run, value, volume, deadline)
+                elif opcode == OP_STOP:
+                    stopped = True
+                run.event = next(run.events, None)
+            if stopped or run.event is None:
+                finished.append(run)
+            else:
+                self._push(run)
+
+        if set_mask or clear_mask:
+            went_high, went_low = self.pins.apply(set_mask, clear_mask)
+            fired = self.clock.now()
+            self.recorder.record(CUE_GPIO, deadline, fired)
+            if log.isEnabledFor(logging.DEBUG):
+                late = (fired - deadline) * 1000
+                for pin in pins_of(went_high):
+                    log.debug("[+] Pin %d HIGH (+%.2f ms)", pin, late)
+                for pin in pins_of(went_low):
+                    log.debug("[-] Pin %d LOW (+%.2f ms)", pin, late)
+
+        for run in finished:
+            log.info("[*] STOP event reached. Ending processing.")
+            if len(self.runs) == 1:
+                #  Wait for all audio playbacks to finish before cleanup
+                self.audio.wait_idle(wake)
+            self._end(run)
+        return True
+
+    def cancel(self, run:_Run):
+        """Stops a running sequence immediately."""
+        run.handle.stop_event.set()
+        log.info("[*] Sequence cancelled by user.")
+        self._end(run, cancelled=True)
+
+    def cancel_stopped(self):
+        """Cancels every running sequence whose stop handle was used."""
+        for run in [run for run in self.runs if run.handle.stop_event.is_set()]:
+            self.cancel(run)
+
+    def _end(self, run:_Run, cancelled:bool = False):
+        self.runs.remove(run)
+        if cancelled:
+            #  Only its own sounds: a sequence preempting it has booked channels already
+            self.audio.stop(run.handle.id)
+        else:
+            self.audio.release(run.handle.id)
+        self._heap = [entry for entry in self._heap if entry[2] is not run]
+        heapq.heapify(self._heap)
+        if self.runs:
+            #  Switch off the pins no other running sequence uses
+            others = 0
+            for other in self.runs:
+                others |= other.pins
+            if run.pins & ~others:
+                self.pins.apply(0, run.pins & ~others)
+        else:
+            print_report(self.recorder)
+            # Cleanup: Pins deaktivieren
+            self.pins.all_off()
+        run.handle.done.set()
 
-def process_sequence(instructions:list[str],stop_event):
+
+def process_instruction_list(timeline:Timeline, audio_controller:AudioController,stop_event, pins:PinDriver,
+                             recorder:CueRecorder|None = None):
     """
-    Handles GPIO pin control and audio playback based on parsed instruction sequences.
+    Executes the GPIO/audio events of a compiled timeline in sequence.
+    All pin changes sharing a timestamp are applied as one bank write.
+    Scheduled and actual fire time of every cue go to the recorder.
     """
-    print("[*] Starting GPIO+Audio Controller")
+    if stop_event.is_set():
+        log.info("[*] Sequence cancelled by user.")
+        return False
+
+    try:
+        scheduler = SequenceScheduler(audio_controller, pins, recorder if recorder is not None else CueRecorder())
+        scheduler.start(SequenceHandle(0, timeline, stop_event))
+        while scheduler.runs:
+            if stop_event.is_set():
+                scheduler.cancel_stopped()
+                break
+            scheduler.step(stop_event)
+
+        time.sleep(0.1)
+
+        return True
+
+    except Exception as e:
+        log.exception(f"[?] Error processing: {e}")
+        return False
+
+
+def process_sequence(timeline:Timeline,stop_event):
+    """
+    Handles GPIO pin control and audio playback based on a compiled timeline.
+    """
+    log.info("[*] Starting GPIO+Audio Controller")
+    INSTRUCTIONS_DIR.mkdir(parents=True, exist_ok=True)
 
     audio_controller = AudioController()
-    
+    pins = PinDriver(create_backend())
+
     try:
-        print("[*] Processing ...")
-        if process_instruction_list(instructions, audio_controller,stop_event):
-            print("[!] Process completed")
+        log.info("[*] Processing ...")
+        if process_instruction_list(timeline, audio_controller,stop_event, pins):
+            log.info("[!] Process completed")
         else:
-            print("[?] Failed to process")
+            log.warning("[?] Failed to process")
 
         time.sleep(0.1)
             
     except KeyboardInterrupt:
-        print("\n[*] Shutting down...")
+        log.info("\n[*] Shutting down...")
     finally:
         audio_controller.cleanup()
-        GPIO.cleanup()
-        print("\n[*] Controller stopped.")
+        pins.cleanup()
+        log.info("\n[*] Controller stopped.")
 
+
+class Player:
+    """
+    Long-lived playback runtime. The mixer, GPIO backend and sound cache are set
+    up once and one dedicated thread plays every sequence, so starting a show is
+    only a queue hand-off. Sequences can preempt, queue behind or run merged
+    with the ones already playing; each gets its own stop handle.
+    Uploaded audio is kept between shows.
+    """
+
+    def __init__(self, cache:SoundCache = sound_cache, backend=None, realtime_mode:bool|None = None):
+        INSTRUCTIONS_DIR.mkdir(parents=True, exist_ok=True)
+        #  Opt-in priority, CPU isolation and GC control (see realtime.py)
+        self.realtime_mode = realtime.enabled() if realtime_mode is None else realtime_mode
+        #  What the realtime settings achieved, reported over Bluetooth
+        self.realtime:dict[str, str] = {}
+        self.audio = AudioController(cache)
+        self.pins = PinDriver(backend if backend is not None else create_backend())
+        self._commands = queue.SimpleQueue()
+        #  Set whenever the player thread has to look at commands or stop handles
+        self._wake = threading.Event()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.sequences:dict[int, SequenceHandle] = {}
+        #  Timing of the last run, reported over Bluetooth
+        self.telemetry = CueRecorder()
+        self._thread = threading.Thread(target=self._run, name="player", daemon=True)
+        self._thread.start()
+        log.info("[*] Player ready")
+
+    def play(self, timeline:Timeline, mode:str = PREEMPT) -> SequenceHandle:
+        """
+        Hands a sequence to the player thread. By default it stops whatever
+        is playing; see QUEUE and MERGE for the alternatives.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown play mode {mode!r}")
+        handle = SequenceHandle(next(self._ids), timeline, wake=self._wake)
+        #  Decoding and GPIO setup happen on the calling thread; on the player
+        #  thread the cues of the running sequences would wait for them
+        sound_files = [INSTRUCTIONS_DIR / sound for sound in timeline.sounds]
+        if mode == QUEUE:
+            #  Starts when nothing else plays, its channels are reserved then
+            self.audio.load(sound_files)
+        else:
+            handle.reservations = self.audio.prepare(timeline, sound_files, handle.id)
+        self.pins.configure(timeline.pin_mask())
+        with self._lock:
+            for number in [number for number, other in self.sequences.items() if other.done.is_set()]:
+                del self.sequences[number]
+            self.sequences[handle.id] = handle
+        self._commands.put((mode, handle))
+        self._wake.set()
+        return handle
+
+    def active_sounds(self) -> set[str]:
+        """Sound names of every sequence that is playing or queued."""
+        with self._lock:
+            handles = [handle for handle in self.sequences.values() if not handle.done.is_set()]
+        return {sound for handle in handles for sound in handle.timeline.sounds}
+
+    def stop(self, sequence_id:int|None = None) -> bool:
+        """Stops one sequence by id, or every running and queued one. False if the id is unknown."""
+        with self._lock:
+            if sequence_id is None:
+                handles = list(self.sequences.values())
+            else:
+                handles = [self.sequences[sequence_id]] if sequence_id in self.sequences else []
+        for handle in handles:
+            handle.stop()
+        return bool(handles) or sequence_id is None
+
+    def _start(self, scheduler:SequenceScheduler, handle:SequenceHandle):
+        if handle.stop_event.is_set():
+            self.audio.release(handle.id)
+            handle.done.set()
+            return
+        log.info(f"[*] Processing sequence {handle.id} ...")
+        if self.realtime_mode and not scheduler.runs:
+            #  Nothing may trigger a collection while sequences are playing
+            self.realtime["gc"] = realtime.pause_gc()
+        scheduler.start(handle)
+
+    def _run(self):
+        if self.realtime_mode:
+            self.realtime.update(realtime.apply_thread_settings())
+        scheduler = SequenceScheduler(self.audio, self.pins, self.telemetry)
+        pending:deque[SequenceHandle] = deque()
+        while True:
+            self._wake.clear()
+            try:
+                #  Block only while idle, otherwise just look for new commands
+                if not scheduler.runs and not pending:
+                    if self.realtime_mode and not gc.isenabled():
+                        realtime.resume_gc()
+                    command = self._commands.get()
+                else:
+                    command = self._commands.get_nowait()
+            except queue.Empty:
+                command = False
+            if command is None:
+                break
+
+            try:
+                if command:
+                    mode, handle = command
+                    if mode == PREEMPT:
+                        for run in list(scheduler.runs):
+                            scheduler.cancel(run)
+                        for queued in pending:
+                            queued.done.set()
+                        pending.clear()
+                        self._start(scheduler, handle)
+                    elif mode == MERGE or not (scheduler.runs or pending):
+                        self._start(scheduler, handle)
+                    else:
+                        log.info(f"[*] Sequence {handle.id} queued")
+                        pending.append(handle)
+                    continue
+
+                scheduler.cancel_stopped()
+                if scheduler.runs:
+                    scheduler.step(self._wake)
+                elif pending:
+                    self._start(scheduler, pending.popleft())
+            except Exception as e:
+                log.exception(f"[?] Error processing: {e}")
+                for run in list(scheduler.runs):
+                    scheduler.cancel(run)
+
+        for run in list(scheduler.runs):
+            scheduler.cancel(run)
+        for queued in pending:
+            queued.done.set()
+
+    def shutdown(self):
+        """Stops playback and releases mixer and GPIO."""
+        self.stop()
+        self._commands.put(None)
+        self._wake.set()
+        self._thread.join()
+        self.audio.stop()
+        mixer().quit()
+        self.pins.cleanup()
+        log.info("\n[*] Controller stopped.")
@@ -0,0 +1,97 @@
+# Scripted stand-in for bluetoothctl, for running the Bluetooth manager without BlueZ
+#
+#   ECOSPARK_BLUETOOTHCTL="python fake_bluetoothctl.py" python bluetooth_auto_accept.py
+#
+# $FAKE_BT_DISCOVERABLE_TIMEOUT (seconds) makes the adapter drop out of
+# discoverable mode after a while, like BlueZ's DiscoverableTimeout does.
+# $FAKE_BT_POWERED=1 starts with the adapter already powered.
+import os
+import sys
+import threading
+
+ADDRESS = "B8:27:EB:CB:26:50"
+PROMPT = "[bluetooth]# "
+
+state = {"power": os.environ.get("FAKE_BT_POWERED") == "1", "discoverable": False, "pairable": False, "agent": False}
+paired = {"AA:BB:CC:DD:EE:01": "Tablet", "AA:BB:CC:DD:EE:02": "Laptop"}
+lock = threading.Lock()
+timer = None
+
+
+def say(line:str):
+    with lock:
+        sys.stdout.write(f"{line}\n{PROMPT}")
+        sys.stdout.flush()
+
+
+def change(setting:str, value:bool):
+    if state[setting] != value:
+        state[setting] = value
+        say(f"[CHG] Controller {ADDRESS} {setting.capitalize()}: {'yes' if value else 'no'}")
+
+
+def discoverable_timeout():
+    change("discoverable", False)
+
+
+def set_discoverable(value:bool):
+    global timer
+    change("discoverable", value)
+    if timer is not None:
+        timer.cancel()
+        timer = None
+    seconds = float(os.environ.get("FAKE_BT_DISCOVERABLE_TIMEOUT", 0))
+    if value and seconds:
+        timer = threading.Timer(seconds, discoverable_timeout)
+        timer.daemon = True
+        timer.start()
+
+
+def handle(command:str, args:list[str]) -> bool:
+    """Answers one command like bluetoothctl. Returns False on quit."""
+    if command in ("quit", "exit"):
+        return False
+    if command in ("power", "discoverable", "pairable") and args in (["on"], ["off"]):
+        value = args[0] == "on"
+        if command == "discoverable":
+            set_discoverable(value)
+        else:
+            change(command, value)
+        say(f"Changing {command} {args[0]} succeeded")
+    elif command == "discoverable-timeout" and args:
+        say(f"Changing discoverable-timeout {args[0]} succeeded")
+    elif command == "agent":
+        say("Agent is already registered" if state["agent"] else "Agent registered")
+        state["agent"] = True
+    elif command == "default-agent":
+        say("Default agent request successful" if state["agent"] else "No agent is registered")
+    elif command == "paired-devices" or (command == "devices" and args == ["Paired"]):
+        for address, name in paired.items():
+            say(f"Device {address} {name}")
+    elif command == "remove" and args:
+        if paired.pop(args[0], None) is None:
+            say(f"Device {args[0]} not available")
+        else:
+            say(f"[DEL] Device {args[0]}")
+            say("Device has been removed")
+    elif command == "show":
+        say(f"Controller {ADDRESS} (public)")
+        for setting in ("power", "discoverable", "pairable"):
+            say(f"\t{'Powered' if setting == 'power' else setting.capitalize()}: {'yes' if state[setting] else 'no'}")
+    elif command == "version":
+        say("Version 5.66")
+    elif command:
+        say(f"Invalid command in menu main: {command}")
+    return True
+
+
+def main():
+    say("Waiting to connect to bluetoothd...")
+    for line in sys.stdin:
+        parts = line.split()
+        if parts and not handle(parts[0], parts[1:]):
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# Streaming file receiver for audio uploads over Bluetooth
+import base64
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from compression import Decompressor
+
+#  Bytes that may appear between base64 characters and are dropped
+_WHITESPACE = b" \t\r\n"
+
+
+class ChecksumError(Exception):
+    """Raised when a received file does not match the announced checksum."""
+
+
+class FileReceiver:
+    """
+    Writes an incoming file to a temporary file in the target directory while
+    hashing it, then atomically renames it into place on finish(). With a codec
+    the data is a compressed stream that is decompressed as it arrives; size
+    and checksum refer to the decompressed file.
+    """
+
+    def __init__(self, directory:Path, filename:str, codec:str|None = None, max_size:int|None = None):
+        #  Only plain file names are accepted, never paths
+        self.filename = Path(filename.strip()).name
+        if not self.filename:
+            raise ValueError("Kein Dateiname angegeben")
+        directory.mkdir(parents=True, exist_ok=True)
+        self.target = directory / self.filename
+        fd, temp_name = tempfile.mkstemp(dir=directory, prefix=f".{self.filename}.", suffix=".part")
+        self.temp_path = Path(temp_name)
+        self._file = os.fdopen(fd, "wb")
+        self._hasher = hashlib.sha256()
+        self.size = 0
+        self._decompressor = Decompressor(codec, max_size) if codec else None
+
+    def write(self, data):
+        """Appends decoded file data."""
+        if self._decompressor is not None:
+            for piece in self._decompressor.feed(data):
+                self._write(piece)
+        else:
+            self._write(data)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._hasher.update(data)
+        self.size += len(data)
+
+    def feed_until_end(self, chunk:bytes) -> bytes|None:
+        """
+        Feeds a chunk of a compressed upload, which ends with its stream. Returns
+        the bytes that followed the end of the stream once it was reached, otherwise None.
+        """
+        self.write(chunk)
+        if self._decompressor.eof:
+            return self._decompressor.unused_data
+        return None
+
+    def finish(self, expected_sha256:str|None = None) -> str:
+        """
+        Flushes the file to disk, verifies the checksum if one was given and
+        renames the file into place. Returns the SHA-256 hex digest.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if self._decompressor is not None and not self._decompressor.eof:
+            self.temp_path.unlink(missing_ok=True)
+            raise ChecksumError(f"Komprimierte Daten unvollstaendig fuer {self.filename}")
+        digest = self._hasher.hexdigest()
+        if expected_sha256 and expected_sha256.strip().lower() != digest:
+            self.temp_path.unlink(missing_ok=True)
+            raise ChecksumError(f"Pruefsumme stimmt nicht ueberein fuer {self.filename}")
+        os.replace(self.temp_path, self.target)
+        return digest
+
+    def abort(self):
+        """Discards the partial file."""
+        if not self._file.closed:
+            self._file.close()
+        self.temp_path.unlink(missing_ok=True)
+
+
+class Base64FileReceiver(FileReceiver):
+    """
+    FileReceiver fed with base64 text in arbitrary chunks. Only an incomplete
+    quantum (< 4 characters) is held back between chunks, so memory stays constant.
+    The text must be whole quanta (padded with "="); anything else is rejected.
+    """
+
+    def __init__(self, directory:Path, filename:str, marker:bytes = b"END"):
+        super().__init__(directory, filename)
+        self.marker = marker
+        self._pending = b""
+        self._held = b""
+
+    def feed(self, chunk:bytes):
+        """Decodes and writes all complete base64 quanta of a chunk."""
+        data = self._pending + chunk.translate(None, _WHITESPACE)
+        usable = len(data) - len(data) % 4
+        if usable:
+            self.write(base64.b64decode(data[:usable]))
+        self._pending = data[usable:]
+
+    def finish(self, expected_sha256:str|None = None) -> str:
+        if self._pending or self._held:
+            #  Base64 that stops inside a quantum was cut short; without a checksum nothing else would notice
+            self.abort()
+            raise ChecksumError(f"Base64-Daten unvollstaendig fuer {self.filename}")
+        return super().finish(expected_sha256)
+
+    def feed_until_end(self, chunk:bytes) -> bytes|None:
+        """
+        Feeds a chunk that may contain the end marker. Returns the bytes that
+        followed the marker once it was found, otherwise None.
+
+        E, N and D are base64 characters, so "END" also occurs inside the data.
+        It only ends the upload at a 4-character boundary, as the last thing in
+        the chunk or followed by a line break; only what comes after that line
+        break is returned (as the next message).
+        """
+        #  The marker may be split across two chunks, so its length - 1 bytes are held back
+        data = self._held + chunk
+        self._held = b""
+        #  Base64 characters before the candidate, counted from the previous one
+        characters, counted = len(self._pending), 0
+        end = data.find(self.marker)
+        while end != -1:
+            characters += len(data[counted:end].translate(None, _WHITESPACE))
+            counted = end
+            rest = self._after_marker(data, end, characters)
+            if rest is not None:
+                self.feed(data[:end])
+                return rest
+            end = data.find(self.marker, end + 1)
+        hold = len(self.marker) - 1
+        self.feed(data[:-hold])
+        self._held = data[-hold:]
+        return None
+
+    def _after_marker(self, data:bytes, end:int, characters:int) -> bytes|None:
+        """
+        What follows the marker at data[end] if it ends the upload there, otherwise
+        None. characters is the number of base64 characters received before it.
+        """
+        if characters % 4:
+            return None
+        after = data[end + len(self.marker):].lstrip(b" \t")
+        if not after:
+            return b""
+        if after[:1] not in b"\r\n":
+            return None
+        return after.lstrip(b"\r\n")
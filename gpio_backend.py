@@ -0,0 +1,208 @@
+# GPIO backends with a shadow pin register and batched bank writes
+import mmap
+import os
+import threading
+from service_log import get_logger
+
+log = get_logger(__name__)
+
+"""
+Pins are handled as bit masks (bit n = BCM pin n). The PinDriver keeps a
+shadow copy of all output levels, so the player never reads pins back and
+only writes the bits that actually change, once per timestamp.
+"""
+
+#  Register offsets (in 32 bit words) of the BCM283x GPIO block in /dev/gpiomem
+_GPFSEL0 = 0x00 // 4
+_GPSET0 = 0x1C // 4
+_GPCLR0 = 0x28 // 4
+
+
+def pins_of(mask:int):
+    """Yields the pin numbers set in a mask, lowest first."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def mask_of(pins) -> int:
+    """Builds a mask from pin numbers."""
+    mask = 0
+    for pin in pins:
+        mask |= 1 << pin
+    return mask
+
+
+class SimulatedGPIOBackend:
+    """
+    Pure Python backend for running the player without a Raspberry Pi.
+    Every bank write is recorded in `writes` as (set_mask, clear_mask).
+    """
+    name = "sim"
+
+    def __init__(self, record:bool = True):
+        self.level = 0
+        self.outputs = 0
+        self.record = record
+        self.writes:list[tuple[int, int]] = []
+
+    def setup_outputs(self, mask:int):
+        self.outputs |= mask
+        self.level &= ~mask
+
+    def write_bank(self, set_mask:int, clear_mask:int):
+        self.level = (self.level & ~clear_mask) | set_mask
+        if self.record:
+            self.writes.append((set_mask, clear_mask))
+
+    def cleanup(self):
+        self.level = 0
+        self.outputs = 0
+
+
+class RPiGPIOBackend:
+    """
+    Backend using RPi.GPIO. A bank write becomes one GPIO.output call with
+    the lists of changed channels and their values.
+    """
+    name = "rpi"
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+
+    def setup_outputs(self, mask:int):
+        pins = list(pins_of(mask))
+        if pins:
+            self.GPIO.setup(pins, self.GPIO.OUT, initial=self.GPIO.LOW)
+
+    def write_bank(self, set_mask:int, clear_mask:int):
+        channels = list(pins_of(set_mask | clear_mask))
+        values = [self.GPIO.HIGH if set_mask >> pin & 1 else self.GPIO.LOW for pin in channels]
+        self.GPIO.output(channels, values)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class GpiomemBackend:
+    """
+    Backend writing the GPSET0/GPCLR0 registers through /dev/gpiomem, so all
+    changes of a bank land in at most two register writes. Pins 0 - 31 only.
+    """
+    name = "gpiomem"
+
+    def __init__(self, device:str = "/dev/gpiomem"):
+        fd = os.open(device, os.O_RDWR | os.O_SYNC)
+        try:
+            self._mem = mmap.mmap(fd, 4096, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self._regs = memoryview(self._mem).cast("I")
+        self.outputs = 0
+
+    def _set_function(self, pin:int, function:int):
+        reg = _GPFSEL0 + pin // 10
+        shift = (pin % 10) * 3
+        self._regs[reg] = (self._regs[reg] & ~(0b111 << shift)) | (function << shift)
+
+    def setup_outputs(self, mask:int):
+        if mask >> 32:
+            raise ValueError("gpiomem backend only supports BCM pins 0 - 31")
+        #  Drive LOW before switching to output to avoid a glitch
+        self._regs[_GPCLR0] = mask
+        for pin in pins_of(mask):
+            self._set_function(pin, 0b001)
+        self.outputs |= mask
+
+    def write_bank(self, set_mask:int, clear_mask:int):
+        if clear_mask:
+            self._regs[_GPCLR0] = clear_mask
+        if set_mask:
+            self._regs[_GPSET0] = set_mask
+
+    def cleanup(self):
+        #  Like GPIO.cleanup(): outputs low, then back to inputs
+        self._regs[_GPCLR0] = self.outputs
+        for pin in pins_of(self.outputs):
+            self._set_function(pin, 0b000)
+        self.outputs = 0
+        self._regs.release()
+        self._mem.close()
+
+
+BACKENDS = {
+    "rpi": RPiGPIOBackend,
+    "gpiomem": GpiomemBackend,
+    "sim": SimulatedGPIOBackend,
+}
+
+
+def create_backend(name:str|None = None):
+    """
+    Creates the backend named by the argument or $ECOSPARK_GPIO. Without a name
+    RPi.GPIO is used, falling back to the simulated backend if it is missing.
+    """
+    name = name or os.environ.get("ECOSPARK_GPIO")
+    if name:
+        return BACKENDS[name]()
+    try:
+        return RPiGPIOBackend()
+    except ImportError:
+        log.warning("[?] RPi.GPIO not available, using simulated GPIO backend")
+        return SimulatedGPIOBackend()
+
+
+class PinDriver:
+    """
+    Shadow register over a backend: outputs are configured once, all changes
+    of one timestamp are applied as a single bank write and writes that would
+    not change any pin are dropped.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.state = 0
+        self.configured = 0
+        #  Pins of a new sequence are configured from outside the player thread
+        self._lock = threading.Lock()
+
+    def configure(self, mask:int):
+        """Configures the pins in mask as outputs (LOW) unless already done."""
+        with self._lock:
+            self._configure(mask)
+
+    def _configure(self, mask:int):
+        new = mask & ~self.configured
+        if new:
+            self.backend.setup_outputs(new)
+            self.configured |= new
+            self.state &= ~new
+
+    def apply(self, set_mask:int, clear_mask:int) -> tuple[int, int]:
+        """
+        Switches pins on/off, set_mask winning over clear_mask. Returns the
+        masks of the pins that actually went HIGH and LOW.
+        """
+        with self._lock:
+            new_state = (self.state & ~clear_mask) | set_mask
+            went_high = new_state & ~self.state
+            went_low = self.state & ~new_state
+            if went_high or went_low:
+                self._configure(went_high | went_low)
+                self.backend.write_bank(went_high, went_low)
+                self.state = new_state
+        return went_high, went_low
+
+    def all_off(self):
+        """Switches every configured pin LOW."""
+        self.apply(0, self.configured)
+
+    def cleanup(self):
+        self.all_off()
+        self.backend.cleanup()
+        self.configured = 0
+        self.state = 0
@@ -0,0 +1,78 @@
+# Raw PCM sidecar files: uploaded audio stored in the mixer's native sample format
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+
+"""
+Every uploaded audio file gets a sidecar in .pcm/ next to it:
+
+    header (64 bytes) | samples in the mixer format, ready for Sound(buffer=...)
+
+Samples are returned as a memoryview of a read-only mapping, so loading does
+not read the file into a Python bytes object first.
+
+The header records the mixer format the samples were converted to and the
+stat signature and SHA-256 of the source file, so a stale or foreign sidecar
+is ignored and the source is decoded again.
+"""
+
+PCM_DIR_NAME = ".pcm"
+
+_MAGIC = b"EPCM"
+_VERSION = 1
+#  magic, version, sample format, frequency, channels, source mtime_ns, source size, source sha256
+_HEADER = struct.Struct("=4sHhIH2xQQ32s")
+
+
+def pcm_path(path:Path) -> Path:
+    """Sidecar path of an audio file; names linked to the same content share one."""
+    path = path.resolve()
+    return path.parent / PCM_DIR_NAME / f"{path.name}.pcm"
+
+
+def write_pcm(path:Path, audio_format:tuple, signature:tuple, digest:str, samples):
+    """
+    Writes the sidecar of an audio file atomically.
+    audio_format is mixer().get_init(), signature (mtime_ns, size) of the source.
+    """
+    frequency, sample_format, channels = audio_format
+    target = pcm_path(path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(_HEADER.pack(_MAGIC, _VERSION, sample_format, frequency, channels,
+                                    *signature, bytes.fromhex(digest)))
+            file.write(samples)
+        os.replace(temp_name, target)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+
+
+def read_pcm(path:Path, audio_format:tuple, signature:tuple) -> tuple[str, memoryview]|None:
+    """
+    Returns (source sha256, mapped samples) of an audio file's sidecar, or None
+    if there is none or it does not match the source file or mixer format.
+    """
+    try:
+        with open(pcm_path(path), "rb") as file:
+            header = file.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                return None
+            magic, version, sample_format, frequency, channels, mtime_ns, size, digest = _HEADER.unpack(header)
+            if (magic != _MAGIC or version != _VERSION
+                    or (frequency, sample_format, channels) != tuple(audio_format)
+                    or (mtime_ns, size) != tuple(signature)):
+                return None
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    return digest.hex(), memoryview(mapping)[_HEADER.size:]
+
+
+def remove_pcm(path:Path):
+    """Deletes the sidecar of an audio file, if any."""
+    pcm_path(path).unlink(missing_ok=True)
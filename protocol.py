@@ -0,0 +1,116 @@
+# Length-prefixed binary framing for the RFCOMM protocol
+import struct
+import zlib
+from collections import namedtuple
+
+"""
+Frame layout (big endian), sent alongside the text protocol:
+
+    magic (1) | version (1) | type (1) | flags (1) | length (4) | payload | crc32 (4, optional)
+
+The magic byte is not an ASCII digit, so the server can tell framed clients
+from text clients by the first byte they send. File data is sent as raw bytes.
+"""
+
+FRAME_MAGIC = 0xEC
+PROTOCOL_VERSION = 1
+
+HEADER = struct.Struct(">BBBBI")
+CRC = struct.Struct(">I")
+
+#  Flags
+FLAG_CRC = 0x01
+
+#  Frame types below 0x10 mirror the commands of the text protocol
+FRAME_LOGIN = 0
+FRAME_TEST = 1
+FRAME_SEQUENCE = 2
+FRAME_FILE_START = 3   #  payload: "<name>" or "<name>:<sha256>"
+FRAME_START = 4
+FRAME_STOP = 5
+FRAME_SHUTDOWN = 6
+FRAME_START_CACHED = 7   #  payload: sha256 hex of a sequence sent before
+FRAME_TELEMETRY = 8   #  reply: JSON timing report of the last run
+FRAME_EDIT = 9   #  payload: "begin", "append:<records>", "replace:<records>" or "remove:<id>/<id>..."
+FRAME_MISSING = 10   #  payload: "<name>=<sha256>,...", reply: JSON list of the hashes still missing
+FRAME_COMPRESSION = 11   #  payload: offered codecs "zlib,lzma", reply: the one used or "none"
+FRAME_FILE_DATA = 0x10   #  payload: raw file bytes (a compressed stream once negotiated)
+FRAME_FILE_END = 0x11
+FRAME_REPLY = 0x80   #  server -> client, UTF-8 text
+
+#  Largest accepted payload
+MAX_PAYLOAD = 1 << 20
+
+Frame = namedtuple("Frame", "type flags payload")
+
+
+class ProtocolError(Exception):
+    """Raised for malformed frames."""
+
+
+def encode_frame(frame_type:int, payload:bytes = b"", crc:bool = False) -> bytes:
+    """Builds a complete frame."""
+    flags = FLAG_CRC if crc else 0
+    frame = HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, frame_type, flags, len(payload)) + payload
+    if crc:
+        frame += CRC.pack(zlib.crc32(payload))
+    return frame
+
+
+class FrameReader:
+    """
+    Incremental frame decoder over one preallocated buffer.
+
+    Data is received straight into the buffer (get_buffer / buffer_updated, the
+    same interface as asyncio.BufferedProtocol) and frames are handed out as
+    memoryviews into it. A payload view is only valid until the next get_buffer().
+    """
+
+    def __init__(self, max_payload:int = MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self._buffer = bytearray(HEADER.size + max_payload + CRC.size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    def get_buffer(self, sizehint:int = -1) -> memoryview:
+        """Returns the free part of the buffer, moving a partial frame to the front first."""
+        if self._start:
+            remaining = self._end - self._start
+            self._buffer[:remaining] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, remaining
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes:int):
+        """Marks nbytes written into the last buffer as received."""
+        self._end += nbytes
+
+    def feed(self, data:bytes):
+        """Copies already received bytes into the buffer."""
+        view = memoryview(data)
+        while view:
+            buffer = self.get_buffer()
+            if not buffer:
+                raise ProtocolError("Frame buffer full")
+            count = min(len(buffer), len(view))
+            buffer[:count] = view[:count]
+            self.buffer_updated(count)
+            view = view[count:]
+
+    def frames(self):
+        """Yields all complete frames in the buffer."""
+        while self._end - self._start >= HEADER.size:
+            magic, version, frame_type, flags, length = HEADER.unpack_from(self._buffer, self._start)
+            if magic != FRAME_MAGIC or version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Unknown frame header {magic:#x}/{version}")
+            if length > self.max_payload:
+                raise ProtocolError(f"Frame too large ({length} bytes)")
+            payload_start = self._start + HEADER.size
+            frame_end = payload_start + length + (CRC.size if flags & FLAG_CRC else 0)
+            if frame_end > self._end:
+                return
+            payload = self._view[payload_start:payload_start + length]
+            if flags & FLAG_CRC and CRC.unpack_from(self._buffer, payload_start + length)[0] != zlib.crc32(payload):
+                raise ProtocolError("CRC mismatch")
+            self._start = frame_end
+            yield Frame(frame_type, flags, payload)
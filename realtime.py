@@ -0,0 +1,104 @@
+# Real-time execution settings for the playback thread
+import gc
+import os
+import threading
+from service_log import get_logger
+
+log = get_logger(__name__)
+
+"""
+Opt-in with $ECOSPARK_REALTIME=1 (or Player(realtime_mode=True)). The player thread
+applies to itself:
+
+    sched   SCHED_FIFO at $ECOSPARK_RT_PRIORITY (needs CAP_SYS_NICE or an rtprio
+            limit), falling back to the lowest nice value permitted
+    cpu     affinity to $ECOSPARK_CPU (default: the last CPU, e.g. one isolated
+            with isolcpus=3); all other threads of the service, and the
+            processes they start later, are moved off that CPU
+
+and for the duration of a sequence the garbage collector is frozen and
+disabled. Every setting reports whether it took effect.
+"""
+
+DEFAULT_PRIORITY = 50
+#  Nice values tried when SCHED_FIFO is not permitted, best first
+_NICE_LEVELS = (-20, -10, -5)
+
+
+def enabled() -> bool:
+    return os.environ.get("ECOSPARK_REALTIME", "") not in ("", "0")
+
+
+def _set_scheduler(priority:int) -> str:
+    try:
+        #  pid 0 is the calling thread
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return f"SCHED_FIFO priority {priority}"
+    except (AttributeError, OSError) as fifo_error:
+        tid = threading.get_native_id()
+        for nice in _NICE_LEVELS:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, nice)
+                return f"nice {nice} (SCHED_FIFO not permitted: {fifo_error})"
+            except (AttributeError, OSError):
+                continue
+        return f"not applied (SCHED_FIFO: {fifo_error}, nice not permitted)"
+
+
+def _set_affinity(cpu:int|None) -> str:
+    try:
+        available = os.sched_getaffinity(0)
+    except (AttributeError, OSError) as e:
+        return f"not applied ({e})"
+    if len(available) < 2:
+        return "not applied (single CPU)"
+    if cpu is None:
+        cpu = max(available)
+    if cpu not in available:
+        return f"not applied (CPU {cpu} not available)"
+    try:
+        os.sched_setaffinity(0, {cpu})
+    except OSError as e:
+        return f"not applied ({e})"
+
+    #  Keep the rest of the service (Bluetooth, event loop, subprocesses) off that CPU
+    own = threading.get_native_id()
+    moved = 0
+    for tid in os.listdir("/proc/self/task"):
+        if int(tid) == own:
+            continue
+        try:
+            os.sched_setaffinity(int(tid), available - {cpu})
+            moved += 1
+        except OSError:
+            pass
+    return f"CPU {cpu} ({moved} other threads moved off)"
+
+
+def apply_thread_settings(priority:int|None = None, cpu:int|None = None) -> dict[str, str]:
+    """Applies scheduling class and CPU affinity to the calling thread, returns what took effect."""
+    if priority is None:
+        priority = int(os.environ.get("ECOSPARK_RT_PRIORITY", DEFAULT_PRIORITY))
+    if cpu is None and os.environ.get("ECOSPARK_CPU"):
+        cpu = int(os.environ["ECOSPARK_CPU"])
+    report = {"sched": _set_scheduler(priority), "cpu": _set_affinity(cpu)}
+    for setting, result in report.items():
+        log.info(f"[*] Realtime {setting}: {result}")
+    return report
+
+
+def pause_gc() -> str:
+    """
+    Collects once, moves every surviving object to the permanent generation and
+    disables the collector, so no collection pause can hit a running sequence.
+    """
+    gc.collect()
+    gc.freeze()
+    gc.disable()
+    return f"frozen ({gc.get_freeze_count()} objects)"
+
+
+def resume_gc():
+    """Re-enables the collector after a sequence."""
+    gc.unfreeze()
+    gc.enable()
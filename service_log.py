@@ -0,0 +1,107 @@
+# Leveled logging with a background writer
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+"""
+Every module logs through get_logger(). Records are formatted by the thread
+that logs them and put on a bounded queue; one writer thread does all console
+I/O, so a slow console or journald never blocks the player or the event loop.
+If the writer falls behind, records are dropped (and counted) instead.
+
+$ECOSPARK_LOG_LEVEL selects the level: debug (every pin change and audio cue),
+info (default: connections, commands, one line per sequence), warning, error.
+"""
+
+LEVEL_ENV = "ECOSPARK_LOG_LEVEL"
+#  Records waiting for the writer thread before new ones are dropped
+QUEUE_SIZE = 10000
+
+_ROOT = "ecospark"
+_listener:logging.handlers.QueueListener|None = None
+_handler:"_DroppingQueueHandler|None" = None
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: a record that does not fit is dropped."""
+
+    def __init__(self, record_queue:queue.Queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                #  Keep dropping until the writer caught up with half the queue
+                if self.queue.qsize() > QUEUE_SIZE // 2:
+                    self.dropped += 1
+                    return
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": _ROOT, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"[?] {self.dropped} log records dropped"}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _ConsoleHandler(logging.StreamHandler):
+    """Writes to the current sys.stdout (systemd passes it on to journald)."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, _stream):
+        pass
+
+
+def _level_from_env() -> int:
+    name = os.environ.get(LEVEL_ENV, "info").strip().upper()
+    level = logging.getLevelName(name)
+    return level if isinstance(level, int) else logging.INFO
+
+
+def _configure():
+    """Starts the writer thread on first use."""
+    global _listener, _handler
+    record_queue = queue.Queue(QUEUE_SIZE)
+    _handler = _DroppingQueueHandler(record_queue)
+    console = _ConsoleHandler()
+    console.setFormatter(logging.Formatter("%(message)s"))
+    _listener = logging.handlers.QueueListener(record_queue, console)
+    _listener.start()
+    atexit.register(flush)
+
+    root = logging.getLogger(_ROOT)
+    root.addHandler(_handler)
+    root.setLevel(_level_from_env())
+    #  The service's records never reach handlers an embedding application set up
+    root.propagate = False
+
+
+def get_logger(name:str) -> logging.Logger:
+    """Logger of a module, writing through the background writer."""
+    if _listener is None:
+        _configure()
+    return logging.getLogger(f"{_ROOT}.{name}")
+
+
+def set_level(level:int|str):
+    """Changes the level of all service loggers (e.g. logging.WARNING for production)."""
+    if _listener is None:
+        _configure()
+    logging.getLogger(_ROOT).setLevel(level.upper() if isinstance(level, str) else level)
+
+
+def flush():
+    """Writes out every queued record and stops the writer (at exit)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        logging.getLogger(_ROOT).removeHandler(_handler)
@@ -0,0 +1,185 @@
+# Editable shows: effects addressed by id and patched without recompiling the whole show
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from convert_data import Timeline, OP_AUDIO, OP_STOP, effect_events, effect_periodic, iter_records, parse_record
+
+"""
+Records sent for editing may carry an id: "<id>=<record>", e.g.
+
+    fx7=light,5,1000,2000,100
+
+Records without one are numbered by their position in the show ("0", "1", ...),
+so a show sent in full with command 2 can be patched by index afterwards.
+"""
+
+
+#  Pending events up to this many are inserted one by one, more are merged in one pass
+BISECT_LIMIT = 256
+
+
+def _key(time_ms:int, opcode:int, arg:int) -> int:
+    """Sort key of an event, the same order Timeline.sort() uses."""
+    return (time_ms << 24) | (opcode << 16) | arg
+
+
+def split_id(record:str) -> tuple[str|None, str]:
+    """Splits "<id>=<record>" into (id, record); id is None if there is none."""
+    effect_id, separator, rest = record.partition("=")
+    if not separator:
+        return None, record.strip()
+    return effect_id.strip(), rest.strip()
+
+
+class ShowEditor:
+    """
+    A show kept as individually addressable effects. The compiled event table
+    is kept sorted and patched in place: events of added effects are collected
+    and go into the table when it is next needed, a few by binary insertion, a
+    whole show (or a streamed chunk of it) sorted and merged in one pass.
+    Removing an effect deletes its events. Nothing else is parsed or sorted
+    again, timeline() only copies the table.
+    """
+
+    def __init__(self):
+        self.effects:dict[str, tuple] = {}   #  id -> parsed effect
+        self._keys = array("Q")              #  sorted event keys (time, opcode, arg)
+        self._volumes = array("B")
+        self._owners = array("I")            #  serial of the effect an event belongs to
+        self._pending:list[tuple[int, int, int]] = []   #  (key, volume, serial) not in the table yet
+        self._serials:dict[str, int] = {}
+        self._next_serial = 0
+        self._next_position = 0
+        self._periodic:dict[str, tuple] = {}
+        self.sounds:list[str] = []
+        self._sound_ids:dict[str, int] = {}
+
+    @classmethod
+    def parse(cls, transmission:str) -> "ShowEditor":
+        """Builds an editor from a complete transmission (ids by position)."""
+        editor = cls()
+        editor.append(iter_records([transmission]))
+        return editor
+
+    def __len__(self):
+        return len(self.effects)
+
+    def _sound_id(self, effect:tuple) -> int:
+        if effect[0] != "sound":
+            return 0
+        sound_id = self._sound_ids.get(effect[1])
+        if sound_id is None:
+            sound_id = self._sound_ids[effect[1]] = len(self.sounds)
+            self.sounds.append(effect[1])
+        return sound_id
+
+    def _insert(self, effect_id:str, effect:tuple):
+        serial = self._next_serial
+        self._next_serial += 1
+        self.effects[effect_id] = effect
+        self._serials[effect_id] = serial
+        self._pending.extend((_key(time_ms, opcode, arg), volume, serial)
+                             for time_ms, opcode, arg, volume in effect_events(effect, self._sound_id(effect)))
+        periodic = effect_periodic(effect)
+        if periodic is not None:
+            self._periodic[effect_id] = periodic
+
+    def _flush(self):
+        """Moves the pending events into the sorted table (after equal keys, like bisect_right)."""
+        pending, self._pending = self._pending, []
+        if len(pending) <= BISECT_LIMIT:
+            for key, volume, serial in pending:
+                index = bisect_right(self._keys, key)
+                self._keys.insert(index, key)
+                self._volumes.insert(index, volume)
+                self._owners.insert(index, serial)
+            return
+        #  Stable sort, and merge keeps the table's events first among equal keys
+        pending.sort(key=itemgetter(0))
+        merged = list(heapq.merge(zip(self._keys, self._volumes, self._owners), pending, key=itemgetter(0)))
+        self._keys = array("Q", [event[0] for event in merged])
+        self._volumes = array("B", [event[1] for event in merged])
+        self._owners = array("I", [event[2] for event in merged])
+
+    def _delete(self, effect_id:str):
+        self._flush()
+        effect = self.effects.pop(effect_id)
+        serial = self._serials.pop(effect_id)
+        self._periodic.pop(effect_id, None)
+        for time_ms, opcode, arg, _ in effect_events(effect, self._sound_id(effect)):
+            index = bisect_left(self._keys, _key(time_ms, opcode, arg))
+            #  Other effects may have an event with the same key
+            while self._owners[index] != serial:
+                index += 1
+            del self._keys[index]
+            del self._volumes[index]
+            del self._owners[index]
+
+    def append(self, records) -> int:
+        """
+        Adds effects. Records without id get the next position as id.
+        Returns the number of records added; raises ValueError for a taken id.
+        """
+        added = 0
+        for record in records:
+            effect_id, record = split_id(record)
+            if effect_id is None:
+                effect_id = str(self._next_position)
+            self._next_position += 1
+            if effect_id in self.effects:
+                raise ValueError(f"Effekt {effect_id} existiert bereits")
+            effect = parse_record(record)
+            if effect is not None:
+                self._insert(effect_id, effect)
+            added += 1
+        return added
+
+    def replace(self, records) -> int:
+        """Replaces effects by id (adding those that do not exist). Returns the number of records."""
+        replaced = 0
+        for record in records:
+            effect_id, record = split_id(record)
+            if effect_id is None:
+                raise ValueError(f"Effekt ohne Id: {record}")
+            if effect_id in self.effects:
+                self._delete(effect_id)
+            effect = parse_record(record)
+            if effect is not None:
+                self._insert(effect_id, effect)
+            replaced += 1
+        return replaced
+
+    def remove(self, effect_ids) -> int:
+        """Removes effects by id, returns how many existed."""
+        removed = 0
+        for effect_id in effect_ids:
+            if effect_id in self.effects:
+                self._delete(effect_id)
+                removed += 1
+        return removed
+
+    def timeline(self) -> Timeline:
+        """The show as a Timeline ending with STOP, copied from the sorted table."""
+        self._flush()
+        keys = self._keys
+        timeline = Timeline()
+        timeline.times = array("I", [key >> 24 for key in keys])
+        timeline.opcodes = array("B", [(key >> 16) & 0xFF for key in keys])
+        timeline.volumes = array("B", self._volumes)
+        #  Renumber the sounds still in use, removed effects may have left some unused
+        renumbered:dict[int, int] = {}
+        args = array("H")
+        for key, opcode in zip(keys, timeline.opcodes):
+            arg = key & 0xFFFF
+            if opcode == OP_AUDIO:
+                if arg not in renumbered:
+                    renumbered[arg] = len(timeline.sounds)
+                    timeline.sounds.append(self.sounds[arg])
+                arg = renumbered[arg]
+            args.append(arg)
+        timeline.args = args
+        for periodic in self._periodic.values():
+            timeline.append_periodic(*periodic)
+        timeline.append(timeline.duration() + 1000 if len(timeline) else 0, OP_STOP)
+        return timeline
@@ -0,0 +1,176 @@
+# Binary show files: compiled timelines cached on disk by the hash of their transmission
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from pathlib import Path
+from convert_data import Timeline, compile_transmission
+from service_log import get_logger
+
+log = get_logger(__name__)
+
+"""
+Show file layout (native byte order, every section naturally aligned):
+
+    header | periodic_pins (Q) | times, periodic_starts, periodic_periods,
+    periodic_counts (I) | args (H) | opcodes, volumes (B) | sound names (UTF-8, "\\n" separated)
+
+Loading maps the file and casts memoryviews over the sections, so a cached
+show is usable without parsing or copying the event table.
+
+The cache is limited in size: every hit updates the modification time of its
+file, and storing a show evicts the least recently used ones beyond the limit.
+"""
+
+SHOW_DIR = Path.home() / 'Desktop' / 'Instructions' / 'shows'
+#  Disk space for cached shows in bytes
+DEFAULT_LIMIT = 64 * 1024 * 1024
+
+_MAGIC = b"ESHW"
+_VERSION = 1
+#  magic, version, little endian, events, periodic effects, sound bytes (padded to 8 bytes)
+_HEADER = struct.Struct("=4sHHIII4x")
+
+
+def _sections(timeline:Timeline):
+    """The arrays of a timeline in file order."""
+    return (timeline.periodic_pins, timeline.times, timeline.periodic_starts, timeline.periodic_periods,
+            timeline.periodic_counts, timeline.args, timeline.opcodes, timeline.volumes)
+
+
+def write_show(path:Path, timeline:Timeline):
+    """Writes a timeline to a show file atomically and durably (it has to survive a power cut)."""
+    sounds = "\n".join(timeline.sounds).encode()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(_HEADER.pack(_MAGIC, _VERSION, sys.byteorder == "little",
+                                    len(timeline.times), len(timeline.periodic_starts), len(sounds)))
+            for section in _sections(timeline):
+                file.write(section)
+            file.write(sounds)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_name, path)
+        #  Persist the rename itself
+        directory = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+
+
+def read_show(path:Path) -> Timeline:
+    """Maps a show file and returns a Timeline backed by the mapping."""
+    with open(path, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapping) < _HEADER.size:
+        raise ValueError(f"Truncated show file {path.name}")
+    magic, version, little_endian, events, periodic, sound_bytes = _HEADER.unpack_from(mapping)
+    if magic != _MAGIC or version != _VERSION or bool(little_endian) != (sys.byteorder == "little"):
+        raise ValueError(f"Incompatible show file {path.name}")
+    #  Q periodic pins, I times and 3 periodic columns, H args, B opcodes and volumes, then the names
+    expected = _HEADER.size + 8 * periodic + 4 * (events + 3 * periodic) + 2 * events + 2 * events + sound_bytes
+    if len(mapping) != expected:
+        raise ValueError(f"Show file {path.name} has {len(mapping)} bytes, its header describes {expected}")
+
+    view = memoryview(mapping)
+    offset = _HEADER.size
+
+    def section(fmt:str, count:int):
+        nonlocal offset
+        size = struct.calcsize(fmt) * count
+        data = view[offset:offset + size].cast(fmt)
+        offset += size
+        return data
+
+    timeline = Timeline()
+    timeline.periodic_pins = section("Q", periodic)
+    timeline.times = section("I", events)
+    timeline.periodic_starts = section("I", periodic)
+    timeline.periodic_periods = section("I", periodic)
+    timeline.periodic_counts = section("I", periodic)
+    timeline.args = section("H", events)
+    timeline.opcodes = section("B", events)
+    timeline.volumes = section("B", events)
+    sounds = bytes(view[offset:offset + sound_bytes]).decode()
+    timeline.sounds = sounds.split("\n") if sounds else []
+    return timeline
+
+
+class ShowStore:
+    """
+    Compiled shows keyed by the SHA-256 of their transmission text, so a show
+    that was sent before (even before a reboot) is never converted again.
+    """
+
+    def __init__(self, directory:Path = SHOW_DIR, limit:int = DEFAULT_LIMIT):
+        self.directory = directory
+        self.limit = limit
+
+    @staticmethod
+    def key(transmission:str) -> str:
+        return hashlib.sha256(transmission.encode()).hexdigest()
+
+    def path(self, key:str) -> Path:
+        if len(key) != 64 or any(char not in "0123456789abcdef" for char in key):
+            raise ValueError(f"Invalid show hash {key!r}")
+        return self.directory / f"{key}.show"
+
+    def load(self, key:str) -> Timeline|None:
+        """Returns the cached show for a hash, or None if there is none."""
+        path = self.path(key.strip().lower())
+        try:
+            timeline = read_show(path)
+            #  The modification time is the last use for the eviction
+            os.utime(path)
+            return timeline
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            log.warning(f"[?] Ignoring cached show: {e}")
+            return None
+
+    def _evict(self, keep:Path):
+        """Deletes the least recently used shows until the cache fits the limit."""
+        shows = []
+        for path in self.directory.glob("*.show"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            shows.append((stat.st_mtime, stat.st_size, path))
+        usage = sum(size for _, size, _ in shows)
+        #  A running show keeps its mapping when its file is deleted
+        for _, size, path in sorted(shows):
+            if usage <= self.limit:
+                break
+            if path != keep:
+                path.unlink(missing_ok=True)
+                usage -= size
+                log.info(f"[*] Evicted cached show {path.stem[:12]}")
+
+    def compile(self, transmission:str) -> tuple[str, Timeline]:
+        """Returns (hash, timeline), compiling and storing the show only on a cache miss."""
+        key = self.key(transmission)
+        timeline = self.load(key)
+        if timeline is not None:
+            log.info(f"[*] Using cached show {key[:12]}")
+            return key, timeline
+        timeline = compile_transmission(transmission)
+        try:
+            write_show(self.path(key), timeline)
+            self._evict(keep=self.path(key))
+        except OSError as e:
+            log.warning(f"[?] Could not cache show {key[:12]}: {e}")
+        return key, timeline
+
+
+#  Shared store used by the Bluetooth service
+show_store = ShowStore()
@@ -0,0 +1,164 @@
+# Dry run of sequences against a virtual clock
+import argparse
+import logging
+import sys
+import threading
+import time
+from pathlib import Path
+from convert_data import Timeline, compile_transmission
+from ecospark_pin import SequenceHandle, SequenceScheduler
+from gpio_backend import PinDriver, SimulatedGPIOBackend, pins_of
+from telemetry import CueRecorder
+import service_log
+
+"""
+simulate() plays a compiled sequence through the same SequenceScheduler the
+player uses, but on a virtual clock: waiting for a deadline only advances the
+clock, so a show runs as fast as the CPU allows. Pins go to a backend that
+records every bank write, audio to a sink that logs every cue and never
+touches the mixer or the audio files.
+
+The trace has one line per pin change and audio cue, in play order, so two
+runs can be compared with diff:
+
+    python simulator.py show.txt --output trace.txt
+"""
+
+
+class VirtualClock:
+    """Clock in seconds that only moves when the scheduler waits for a deadline."""
+
+    def __init__(self, start:float = 0.0):
+        self.time = start
+
+    def now(self) -> float:
+        return self.time
+
+    def wait_until(self, deadline:float, stop_event) -> bool:
+        """Jumps to the deadline. Returns False if stop_event is set."""
+        if stop_event.is_set():
+            return False
+        if deadline > self.time:
+            self.time = deadline
+        return True
+
+
+class TracingGPIOBackend(SimulatedGPIOBackend):
+    """Simulated backend recording every bank write as (time, set_mask, clear_mask)."""
+    name = "trace"
+
+    def __init__(self, clock:VirtualClock):
+        super().__init__(record=False)
+        self.clock = clock
+        self.trace:list[tuple[float, int, int]] = []
+
+    def write_bank(self, set_mask:int, clear_mask:int):
+        super().write_bank(set_mask, clear_mask)
+        self.trace.append((self.clock.time, set_mask, clear_mask))
+
+
+class AudioCueLog:
+    """Audio controller stand-in logging every cue as (time, file name, volume)."""
+
+    def __init__(self, clock:VirtualClock):
+        self.clock = clock
+        self.cues:list[tuple[float, str, int]] = []
+
+    @staticmethod
+    def prepare(timeline, sound_files, owner=0):
+        return []
+
+    @staticmethod
+    def release(owner):
+        pass
+
+    @staticmethod
+    def load_music():
+        pass
+
+    def play(self, file_path, volume=100, channel=None, owner=None):
+        self.cues.append((self.clock.time, Path(file_path).name, volume))
+        return True
+
+    @staticmethod
+    def wait_idle(stop_event):
+        pass
+
+    def stop(self, owner=None):
+        pass
+
+
+class Simulation:
+    """Result of a dry run: pin writes and audio cues with their virtual times."""
+
+    def __init__(self, pin_writes:list[tuple[float, int, int]], audio_cues:list[tuple[float, str, int]],
+                 duration:float, wall_seconds:float):
+        self.pin_writes = pin_writes
+        self.audio_cues = audio_cues
+        self.duration = duration          #  virtual seconds until the last event
+        self.wall_seconds = wall_seconds  #  real time the dry run took
+
+    def pin_changes(self) -> int:
+        return sum((set_mask | clear_mask).bit_count() for _, set_mask, clear_mask in self.pin_writes)
+
+    def lines(self):
+        """Yields the trace lines ("<ms> ms pin <n> HIGH|LOW" / "<ms> ms audio <file> volume <v>")."""
+        pins = iter(self.pin_writes)
+        audio = iter(self.audio_cues)
+        write = next(pins, None)
+        cue = next(audio, None)
+        while write is not None or cue is not None:
+            #  Audio fires before the pin changes of the same moment, like in the scheduler
+            if cue is not None and (write is None or cue[0] <= write[0]):
+                at, name, volume = cue
+                yield f"{round(at * 1000):>10} ms audio {name} volume {volume}"
+                cue = next(audio, None)
+            else:
+                at, set_mask, clear_mask = write
+                for pin in pins_of(clear_mask):
+                    yield f"{round(at * 1000):>10} ms pin {pin} LOW"
+                for pin in pins_of(set_mask):
+                    yield f"{round(at * 1000):>10} ms pin {pin} HIGH"
+                write = next(pins, None)
+
+    def summary(self) -> str:
+        return (f"{self.pin_changes()} pin changes, {len(self.audio_cues)} audio cues over "
+                f"{self.duration:.1f} s, simulated in {self.wall_seconds * 1000:.1f} ms")
+
+
+def simulate(timeline:Timeline) -> Simulation:
+    """Plays a timeline on a virtual clock and returns what would have happened."""
+    clock = VirtualClock()
+    backend = TracingGPIOBackend(clock)
+    audio = AudioCueLog(clock)
+    stop_event = threading.Event()
+    #  Lateness is always zero on a virtual clock, so a small buffer is enough
+    scheduler = SequenceScheduler(audio, PinDriver(backend), CueRecorder(capacity=1024), clock)
+
+    started = time.perf_counter()
+    scheduler.start(SequenceHandle(0, timeline, stop_event))
+    while scheduler.runs:
+        scheduler.step(stop_event)
+    return Simulation(backend.trace, audio.cues, clock.time, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dry run of an EcoSpark sequence")
+    parser.add_argument("sequence", type=Path, help="file with the sequence text (as sent with command 2), - for stdin")
+    parser.add_argument("--output", type=Path, help="write the trace to this file instead of stdout")
+    args = parser.parse_args()
+    #  Only the trace goes to stdout; the scheduler's progress lines would interleave with it
+    service_log.set_level(logging.WARNING)
+
+    transmission = sys.stdin.read() if str(args.sequence) == "-" else args.sequence.read_text()
+    simulation = simulate(compile_transmission(transmission.strip()))
+    trace = "\n".join(simulation.lines()) + "\n"
+    if args.output:
+        args.output.write_text(trace)
+    else:
+        sys.stdout.write(trace)
+    print(f"[*] {simulation.summary()}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+# Decoded-audio cache for pygame sounds with a memory budget and background preloading
+import hashlib
+import threading
+import wave
+from collections import OrderedDict
+from pathlib import Path
+from pcm_file import read_pcm, write_pcm
+from service_log import get_logger
+
+log = get_logger(__name__)
+
+#  Memory budget for decoded sounds in bytes
+DEFAULT_BUDGET = 64 * 1024 * 1024
+#  Tracks decoding to more than this many bytes are streamed from disk instead
+DEFAULT_STREAM_THRESHOLD = 8 * 1024 * 1024
+
+
+def mixer():
+    """Returns pygame.mixer, importing pygame on first use so modules load without it."""
+    import pygame
+    return pygame.mixer
+
+
+class StreamedSound:
+    """
+    Long track played through the mixer's music stream straight from the file,
+    so it stays in the OS page cache instead of the process heap. Only one
+    streamed track plays at a time.
+    """
+
+    def __init__(self, path:Path, length:float):
+        self.path = path
+        self.length = length
+
+    def get_length(self) -> float:
+        return self.length
+
+    def load(self):
+        """Opens the track in the music stream, stopping whatever it played."""
+        mixer().music.load(str(self.path))
+
+    def play(self, volume:float):
+        """Starts the track, which load() must have opened."""
+        music = mixer().music
+        music.set_volume(volume)
+        music.play()
+
+
+def _wav_length(path:Path) -> float|None:
+    """Length in seconds from a WAV header, None if the file is no plain WAV."""
+    try:
+        with wave.open(str(path), "rb") as file:
+            return file.getnframes() / file.getframerate()
+    except (OSError, EOFError, wave.Error, ZeroDivisionError):
+        return None
+
+
+class SoundCache:
+    """
+    Keeps decoded pygame sounds in memory so playing a cue is just a channel start.
+
+    Files are tracked by path and stat signature, sounds by the SHA-256 of their
+    content, so identical files under different names are decoded only once.
+    Least recently used sounds are evicted when the byte budget is exceeded.
+    Tracks above the stream threshold are not decoded at all but returned as
+    StreamedSound.
+    """
+
+    def __init__(self, budget:int = DEFAULT_BUDGET, stream_threshold:int = DEFAULT_STREAM_THRESHOLD):
+        self.budget = budget
+        self.stream_threshold = stream_threshold
+        self.used = 0
+        self._lock = threading.Lock()
+        self._files:dict[Path, tuple] = {}   #  path -> (mtime_ns, size, digest)
+        self._streams:dict[Path, tuple] = {}   #  path -> (mtime_ns, size, StreamedSound)
+        self._sounds:OrderedDict[str, tuple] = OrderedDict()   #  digest -> (sound, nbytes)
+
+    @staticmethod
+    def _signature(path:Path):
+        stat = path.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _decoded_size(sound) -> int:
+        """Size of the decoded samples in the mixer format."""
+        frequency, sample_format, channels = mixer().get_init()
+        return int(sound.get_length() * frequency) * channels * (abs(sample_format) // 8)
+
+    def _streamed(self, path:Path, signature:tuple) -> StreamedSound|None:
+        """A StreamedSound for a file too large to keep decoded, else None."""
+        audio_format = mixer().get_init()
+        length = _wav_length(path)
+        if not audio_format or length is None:
+            return None
+        frequency, sample_format, channels = audio_format
+        if length * frequency * channels * (abs(sample_format) // 8) <= self.stream_threshold:
+            return None
+        stream = StreamedSound(path, length)
+        with self._lock:
+            self._streams[path] = (*signature, stream)
+        return stream
+
+    def get(self, path:Path):
+        """
+        Returns the decoded sound for a file, loading it on a miss.
+        Returns None if the file does not exist or cannot be decoded.
+        """
+        try:
+            signature = self._signature(path)
+        except OSError:
+            return None
+
+        with self._lock:
+            streamed = self._streams.get(path)
+            if streamed is not None and streamed[:2] == signature:
+                return streamed[2]
+            known = self._files.get(path)
+            if known is not None and known[:2] == signature:
+                entry = self._sounds.get(known[2])
+                if entry is not None:
+                    self._sounds.move_to_end(known[2])
+                    return entry[0]
+        return self.load(path)
+
+    def load(self, path:Path):
+        """
+        Decodes a file into the cache and returns the sound (None on failure).
+        A matching PCM sidecar is used as is, without hashing or decoding the file.
+        """
+        try:
+            signature = self._signature(path)
+        except OSError as e:
+            log.warning(f"[?] Audio-Datei nicht lesbar: {path} - {e}")
+            return None
+
+        stream = self._streamed(path, signature)
+        if stream is not None:
+            return stream
+
+        audio_format = mixer().get_init()
+        pcm = read_pcm(path, audio_format, signature) if audio_format else None
+        if pcm is not None:
+            digest, samples = pcm
+            with self._lock:
+                self._files[path] = (*signature, digest)
+                entry = self._sounds.get(digest)
+                if entry is not None:
+                    self._sounds.move_to_end(digest)
+                    return entry[0]
+            return self._insert(digest, mixer().Sound(buffer=samples))
+
+        try:
+            with open(path, "rb") as file:
+                digest = hashlib.file_digest(file, "sha256").hexdigest()
+        except OSError as e:
+            log.warning(f"[?] Audio-Datei nicht lesbar: {path} - {e}")
+            return None
+
+        with self._lock:
+            self._files[path] = (*signature, digest)
+            entry = self._sounds.get(digest)
+            if entry is not None:
+                self._sounds.move_to_end(digest)
+                return entry[0]
+
+        try:
+            sound = mixer().Sound(str(path))
+        except Exception as e:
+            log.warning(f"[?] Failed to decode audio file {path.name}: {e}")
+            return None
+        return self._insert(digest, sound)
+
+    def ingest(self, path:Path, digest:str|None = None) -> bool:
+        """
+        Converts a freshly uploaded file once into the mixer format and stores
+        the samples as PCM sidecar, so later loads need no resampling.
+        Needs the mixer the player initialised; returns False without it.
+        """
+        try:
+            if not mixer().get_init():
+                log.info(f"[*] Mixer not initialised, {path.name} is decoded on first use")
+                return False
+            signature = self._signature(path)
+            #  Long tracks are streamed from the upload itself
+            if self._streamed(path, signature) is not None:
+                log.info(f"[*] {path.name} will be streamed from disk")
+                return True
+            #  Content that was uploaded before already has its sidecar
+            if read_pcm(path, mixer().get_init(), signature) is not None:
+                return self.get(path) is not None
+            if digest is None:
+                with open(path, "rb") as file:
+                    digest = hashlib.file_digest(file, "sha256").hexdigest()
+            #  pygame converts to the mixer format while decoding
+            sound = mixer().Sound(str(path))
+        except Exception as e:
+            log.warning(f"[?] Failed to decode audio file {path.name}: {e}")
+            return False
+
+        try:
+            write_pcm(path, mixer().get_init(), signature, digest, sound.get_raw())
+        except OSError as e:
+            log.warning(f"[?] Could not store PCM of {path.name}: {e}")
+        with self._lock:
+            self._files[path] = (*signature, digest)
+        self._insert(digest, sound)
+        return True
+
+    def _insert(self, digest:str, sound):
+        """Adds a decoded sound and returns the cached one for its digest."""
+        nbytes = self._decoded_size(sound)
+        with self._lock:
+            entry = self._sounds.get(digest)
+            if entry is not None:
+                return entry[0]
+            self._sounds[digest] = (sound, nbytes)
+            self.used += nbytes
+            self._evict()
+        return sound
+
+    def _evict(self):
+        """Drops least recently used sounds until the budget is met (lock held)."""
+        while self.used > self.budget and len(self._sounds) > 1:
+            _, (_, nbytes) = self._sounds.popitem(last=False)
+            self.used -= nbytes
+
+    def invalidate(self, path:Path):
+        """Forgets a file, e.g. after it was deleted or overwritten."""
+        with self._lock:
+            self._streams.pop(path, None)
+            known = self._files.pop(path, None)
+            if known is None:
+                return
+            #  Only drop the sound if no other file shares its content
+            if not any(other[2] == known[2] for other in self._files.values()):
+                entry = self._sounds.pop(known[2], None)
+                if entry is not None:
+                    self.used -= entry[1]
+
+    def preload(self, paths) -> threading.Thread:
+        """Decodes the given files in a background thread."""
+        paths = list(paths)
+
+        def _preload():
+            if not mixer().get_init():
+                mixer().init()
+            for path in paths:
+                if path.exists():
+                    self.get(path)
+            log.info(f"[*] Preloaded {len(paths)} audio files ({self.used / 1048576:.1f} MiB cached)")
+
+        thread = threading.Thread(target=_preload, daemon=True)
+        thread.start()
+        return thread
+
+
+#  Shared cache used by the player and the Bluetooth service
+sound_cache = SoundCache()
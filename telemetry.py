@@ -0,0 +1,123 @@
+# Per-cue timing telemetry of the player
+from array import array
+
+"""
+The player records scheduled and actual fire time of every cue into a
+preallocated ring buffer (no allocation on the timing path). After a run the
+buffer is aggregated into HDR-style histograms per cue type.
+"""
+
+#  Cue types
+CUE_GPIO = 0
+CUE_AUDIO = 1
+CUE_NAMES = {CUE_GPIO: "gpio", CUE_AUDIO: "audio"}
+
+#  Histogram resolution: 32 linear sub-buckets per power of two (~3 % error)
+_SUB_BUCKETS = 32
+_BUCKETS = 1024
+
+
+def _bucket(value:int) -> int:
+    """Histogram bucket of a value in microseconds."""
+    if value < 2 * _SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - 6
+    return min(_BUCKETS - 1, (shift + 1) * _SUB_BUCKETS + (value >> shift) - _SUB_BUCKETS)
+
+
+def _bucket_value(index:int) -> int:
+    """Lowest value (microseconds) that falls into a bucket."""
+    if index < 2 * _SUB_BUCKETS:
+        return index
+    shift = index // _SUB_BUCKETS - 1
+    return (index - (shift + 1) * _SUB_BUCKETS + _SUB_BUCKETS) << shift
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of latencies with microsecond resolution.
+    """
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * _BUCKETS))
+        self.total = 0
+        self.max_us = 0
+
+    def add(self, latency_us:int):
+        latency_us = max(0, latency_us)
+        self.counts[_bucket(latency_us)] += 1
+        self.total += 1
+        if latency_us > self.max_us:
+            self.max_us = latency_us
+
+    def percentile(self, fraction:float) -> int:
+        """Latency in microseconds below which the given fraction of cues fired."""
+        if not self.total:
+            return 0
+        wanted = max(1, round(fraction * self.total))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(_bucket_value(index), self.max_us)
+        return self.max_us
+
+    def summary(self) -> dict:
+        return {
+            "count": self.total,
+            "p50_ms": self.percentile(0.50) / 1000,
+            "p99_ms": self.percentile(0.99) / 1000,
+            "max_ms": self.max_us / 1000,
+        }
+
+
+class CueRecorder:
+    """
+    Ring buffer of (cue type, scheduled time, actual time), times in seconds
+    of the player clock. Once full, the oldest cues are overwritten.
+    """
+
+    def __init__(self, capacity:int = 1 << 16):
+        self.capacity = capacity
+        self.kinds = array("B", bytes(capacity))
+        self.scheduled = array("d", bytes(8 * capacity))
+        self.actual = array("d", bytes(8 * capacity))
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def record(self, kind:int, scheduled:float, actual:float):
+        index = self.count % self.capacity
+        self.kinds[index] = kind
+        self.scheduled[index] = scheduled
+        self.actual[index] = actual
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def lateness_ms(self, kind:int|None = None) -> list[float]:
+        """Lateness of the buffered cues in ms, oldest first."""
+        first = self.count - len(self)
+        result = []
+        for position in range(first, self.count):
+            index = position % self.capacity
+            if kind is None or self.kinds[index] == kind:
+                result.append((self.actual[index] - self.scheduled[index]) * 1000)
+        return result
+
+    def histograms(self) -> dict[int, LatencyHistogram]:
+        """Aggregates the buffered cues into one histogram per cue type."""
+        histograms = {kind: LatencyHistogram() for kind in CUE_NAMES}
+        first = self.count - len(self)
+        for position in range(first, self.count):
+            index = position % self.capacity
+            histograms[self.kinds[index]].add(round((self.actual[index] - self.scheduled[index]) * 1_000_000))
+        return histograms
+
+    def report(self) -> dict:
+        """Timing health of the last run, per cue type."""
+        report = {CUE_NAMES[kind]: histogram.summary() for kind, histogram in self.histograms().items()}
+        report["overwritten"] = self.count - len(self)
+        return report
@@ -0,0 +1,101 @@
+# Bluetooth manager against the scripted bluetoothctl in fake_bluetoothctl.py
+import shlex
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+import pytest
+from bluetooth_auto_accept import BluetoothCtl, BluetoothManager, auto_accept_bluetooth
+
+FAKE_BLUETOOTHCTL = shlex.join([sys.executable, str(Path(__file__).with_name("fake_bluetoothctl.py"))])
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    """Manager on a powered fake adapter; its signal handlers are removed again afterwards."""
+    monkeypatch.setenv("FAKE_BT_POWERED", "1")
+    handlers = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+    manager = BluetoothManager(BluetoothCtl(FAKE_BLUETOOTHCTL))
+    lines = []
+    manager.ctl.add_listener(lines.append)
+    manager.lines = lines
+    yield manager
+    manager.keep_running = False
+    manager.ctl.close()
+    signal.signal(signal.SIGINT, handlers[0])
+    signal.signal(signal.SIGTERM, handlers[1])
+
+
+def wait_for(condition, timeout:float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_setup_steps(manager):
+    #  The adapter is already up, so no reset through systemctl is attempted
+    assert manager.prepare_adapter()
+    assert manager.setup_adapter()
+    assert manager.adapter_ready()
+    assert manager.remove_paired_devices()
+    assert sum("Device has been removed" in line for line in manager.lines) == 2
+    assert manager.ctl.request("paired-devices\nversion", "Version", failure=()) == ["Version 5.66"]
+    assert manager.register_agent()
+    #  A second session step finds the agent registered
+    assert manager.register_agent()
+
+
+def test_keeps_adapter_discoverable(manager, monkeypatch):
+    monkeypatch.setenv("FAKE_BT_DISCOVERABLE_TIMEOUT", "0.1")
+    assert manager.start_session() and manager.setup_adapter()
+    keeper = threading.Thread(target=manager.keep_discoverable, kwargs={"restart_delay": 0})
+    keeper.start()
+    try:
+        #  Every timeout of the adapter is answered with "discoverable on"
+        assert wait_for(lambda: sum("Discoverable: yes" in line for line in manager.lines) >= 3)
+    finally:
+        manager._cleanup()
+        keeper.join(5)
+    assert not keeper.is_alive()
+
+
+def test_restarts_exited_bluetoothctl(manager):
+    assert manager.start_session() and manager.setup_adapter()
+    keeper = threading.Thread(target=manager.keep_discoverable, kwargs={"restart_delay": 0})
+    keeper.start()
+    first = manager.ctl.process
+    try:
+        first.kill()
+        assert wait_for(lambda: manager.ctl.process is not first and manager.ctl.alive())
+        assert wait_for(lambda: "Default agent request successful" in manager.lines)
+    finally:
+        manager._cleanup()
+        keeper.join(5)
+    assert not keeper.is_alive()
+
+
+def run_auto_accept() -> Future:
+    """Runs auto_accept_bluetooth on its own thread, like the service does."""
+    ready = Future()
+    thread = threading.Thread(target=auto_accept_bluetooth, args=(ready,))
+    thread.start()
+    thread.join(10)
+    return ready
+
+
+def test_ready_resolved_when_setup_fails(monkeypatch):
+    monkeypatch.setenv("ECOSPARK_BLUETOOTHCTL", "/nonexistent/bluetoothctl")
+    assert run_auto_accept().result(0) is False
+
+
+def test_ready_resolved_when_setup_crashes(monkeypatch):
+    def crash(_manager):
+        raise RuntimeError("bluetoothd gone")
+
+    monkeypatch.setattr(BluetoothManager, "full_setup", crash)
+    assert run_auto_accept().result(0) is False
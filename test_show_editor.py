@@ -0,0 +1,49 @@
+# Edited shows compared against compiling the same records from scratch
+import random
+from convert_data import OP_AUDIO, compile_transmission, iter_records
+from show_editor import BISECT_LIMIT, ShowEditor
+
+
+def records(count:int, seed:int = 1) -> list[str]:
+    rng = random.Random(seed)
+    result = []
+    for index in range(count):
+        start = rng.randrange(0, 60000)
+        if index % 5 == 0:
+            result.append(f"sound,a{index % 3}.wav,{start},{rng.randrange(101)}")
+        else:
+            result.append(f"light,{rng.randrange(2, 8)},{start},{start + rng.randrange(10, 3000)},{rng.choice(['', 200])}")
+    return result
+
+
+def table(timeline) -> tuple:
+    """
+    Events and periodic effects of a timeline. Sound ids are resolved to file
+    names and periodic effects sorted, the editor orders both differently.
+    """
+    args = [timeline.sounds[arg] if opcode == OP_AUDIO else arg for opcode, arg in zip(timeline.opcodes, timeline.args)]
+    periodic = sorted(zip(timeline.periodic_starts, timeline.periodic_periods,
+                          timeline.periodic_counts, timeline.periodic_pins))
+    return list(timeline.times), list(timeline.opcodes), args, list(timeline.volumes), periodic
+
+
+def test_whole_show_matches_compile():
+    #  Far more events than BISECT_LIMIT, so they are merged in one pass
+    show = records(2000)
+    assert len(show) * 2 > BISECT_LIMIT
+    assert table(ShowEditor.parse("?".join(show)).timeline()) == table(compile_transmission("?".join(show)))
+
+
+def test_streamed_chunks_and_patches_match_compile():
+    show = records(1500)
+    editor = ShowEditor()
+    for start in range(0, len(show), 400):
+        editor.append(iter_records(["?".join(show[start:start + 400])]))
+    #  Small patches on top of the merged table
+    patch = records(3, seed=2)
+    editor.replace(f"{index}={record}" for index, record in zip((7, 1200, 5), patch))
+    editor.remove(["0", "1499"])
+    expected = show[:]
+    expected[7], expected[1200], expected[5] = patch
+    del expected[1499], expected[0]
+    assert table(editor.timeline()) == table(compile_transmission("?".join(expected)))
@@ -0,0 +1,17 @@
+# Show cache size limit
+import os
+from show_store import ShowStore
+
+
+def test_evicts_least_recently_used(tmp_path):
+    store = ShowStore(tmp_path)
+    first, _ = store.compile("light,20,0,100")
+    store.limit = 2 * (tmp_path / f"{first}.show").stat().st_size
+    second, _ = store.compile("light,21,0,100")
+    #  Both were used long ago, the first one again just now
+    for key in (first, second):
+        os.utime(tmp_path / f"{key}.show", (1, 1))
+    assert store.load(first) is not None
+    third, _ = store.compile("light,22,0,100")
+    assert sorted(path.stem for path in tmp_path.glob("*.show")) == sorted([first, third])
+    assert store.load(second) is None
@@ -0,0 +1,57 @@
+# Dry runs compared against the instruction list of convert_to_input
+import pytest
+from convert_data import compile_transmission, convert_to_input
+from simulator import simulate
+
+SHOWS = [
+    "light,20,1000,2000",
+    "light,01/05,1000,2000,200?sound,a.wav,1500,50?three_d,20,0,3000",
+    #  Blink period longer than the effect: one toggle after the end
+    "light,7,0,100,500",
+    "sound,b.wav,0,80?light,3,0,4000,1000?sound,c.wav,2500,20?light,4,2500,2600",
+]
+
+
+def expected_lines(transmission:str) -> list[str]:
+    """
+    Replays the "T<ms> +Pxx -Pxx <file> <volume> ... stop" instructions and
+    formats what changes like Simulation.lines(): audio first, then the pins
+    that go LOW, then the ones that go HIGH. Writes that change nothing are dropped.
+    """
+    high:set[int] = set()
+    lines = []
+    for instruction in convert_to_input(transmission):
+        time, *words = instruction.split()
+        at = int(time[1:])
+        on, off, audio = set(), set(), []
+        while words:
+            word = words.pop(0)
+            if word == "stop":
+                break
+            if word[:2] == "+P":
+                on.add(int(word[2:]))
+                off.discard(int(word[2:]))
+            elif word[:2] == "-P":
+                off.add(int(word[2:]))
+                on.discard(int(word[2:]))
+            else:
+                audio.append((word, words.pop(0)))
+        lines += [f"{at:>10} ms audio {name} volume {volume}" for name, volume in audio]
+        lines += [f"{at:>10} ms pin {pin} LOW" for pin in sorted(off & high)]
+        lines += [f"{at:>10} ms pin {pin} HIGH" for pin in sorted(on - high)]
+        high = (high - off) | on
+    return lines
+
+
+@pytest.mark.parametrize("transmission", SHOWS)
+def test_trace_matches_instructions(transmission):
+    simulation = simulate(compile_transmission(transmission))
+    assert list(simulation.lines()) == expected_lines(transmission)
+
+
+def test_summary_counts():
+    simulation = simulate(compile_transmission(SHOWS[1]))
+    assert simulation.pin_changes() == 22
+    assert [name for _, name, _ in simulation.audio_cues] == ["a.wav"]
+    #  The STOP instruction comes 1000 ms after the last change
+    assert simulation.duration == pytest.approx(4.0)
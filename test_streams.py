@@ -0,0 +1,174 @@
+# Incremental parsers fed with split and coalesced input
+import base64
+import hashlib
+import os
+import pytest
+from compression import Decompressor, compress
+from convert_data import RecordStream
+from file_transfer import Base64FileReceiver, ChecksumError
+from protocol import FrameReader, ProtocolError, encode_frame, FRAME_FILE_DATA, FRAME_SEQUENCE, FRAME_START
+
+RECORDS = ["light,20,1000,2000", "sound,a.wav,1500,50", "three_d,5/6,0,3000"]
+
+
+def pieces(data, size:int):
+    """Splits data into chunks of size."""
+    return [data[index:index + size] for index in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 1000])
+def test_record_stream_split(size):
+    stream = RecordStream()
+    records = []
+    for chunk in pieces("?".join(RECORDS), size):
+        records += stream.feed(chunk)
+    records += stream.close()
+    assert records == RECORDS
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_record_stream_stops_at_marker(size):
+    stream = RecordStream(marker="END")
+    records = []
+    for chunk in pieces("?".join(RECORDS) + "?END?light,1,0,1?", size):
+        records += stream.feed(chunk)
+    assert records == RECORDS
+    assert stream.finished
+
+
+def test_record_stream_keeps_rest_after_marker():
+    stream = RecordStream(marker="END")
+    assert list(stream.feed(RECORDS[0] + "?EN")) == [RECORDS[0]]
+    assert list(stream.feed("D?4")) == []
+    assert stream.finished
+    #  The next command arrived with the end of the stream
+    assert stream.rest == "4"
+
+
+def test_record_stream_marker_without_separator():
+    stream = RecordStream(marker="END")
+    assert list(stream.feed(RECORDS[0] + "?END")) == [RECORDS[0]]
+    assert stream.finished
+    assert list(stream.close()) == []
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 4096])
+def test_base64_receiver_split(tmp_path, size):
+    #  Fixed content whose base64 has "END" off the quantum boundaries (random data would
+    #  sometimes have one on a boundary at the end of a chunk, which does end the upload)
+    content = bytes(range(256)) * 12 + base64.b64decode(b"QENDAEND") * 50
+    assert b"END" in base64.b64encode(content)
+    receiver = Base64FileReceiver(tmp_path, "a.wav")
+    chunks = pieces(base64.b64encode(content) + b"END\n4", size)
+    rest = None
+    while rest is None:
+        rest = receiver.feed_until_end(chunks.pop(0))
+    #  What follows the marker is handed back (or arrives later), never written to the file
+    assert (rest + b"".join(chunks)).lstrip() == b"4"
+    digest = receiver.finish(hashlib.sha256(content).hexdigest())
+    assert (tmp_path / "a.wav").read_bytes() == content
+    assert digest == hashlib.sha256(content).hexdigest()
+
+
+def test_base64_receiver_coalesced(tmp_path):
+    receiver = Base64FileReceiver(tmp_path, "a.wav")
+    assert receiver.feed_until_end(b"QUJD\r\nRE\nVG" + b"EN") is None
+    #  Marker split across chunks, next command in the same chunk
+    assert receiver.feed_until_end(b"D\r\n4") == b"4"
+    receiver.finish()
+    assert (tmp_path / "a.wav").read_bytes() == b"ABCDEF"
+
+
+def test_base64_receiver_ignores_end_in_data(tmp_path):
+    #  "END" inside the base64 text, followed by more data in the same write
+    encoded = b"QUJDRE5EMTIzEND1AAAA"
+    receiver = Base64FileReceiver(tmp_path, "x.wav")
+    assert receiver.feed_until_end(encoded + b"END") == b""
+    receiver.finish()
+    assert (tmp_path / "x.wav").read_bytes() == base64.b64decode(encoded)
+
+
+def test_base64_receiver_ignores_end_off_quantum_boundary(tmp_path):
+    receiver = Base64FileReceiver(tmp_path, "x.wav")
+    #  A write ending in "END" that starts in the middle of a quantum is data
+    assert receiver.feed_until_end(b"QUJDQ") is None
+    assert receiver.feed_until_end(b"END") is None
+    assert receiver.feed_until_end(b"AAAAEND\n") == b""
+    receiver.finish()
+    assert (tmp_path / "x.wav").read_bytes() == base64.b64decode(b"QUJDQENDAAAA")
+
+
+def test_base64_receiver_rejects_partial_quantum(tmp_path):
+    #  What an upload cut short by an "END" inside its data looks like: 7 of 8 characters
+    receiver = Base64FileReceiver(tmp_path, "x.wav")
+    receiver.feed(b"QUJDRE5")
+    with pytest.raises(ChecksumError):
+        receiver.finish()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_base64_receiver_does_not_dispatch_glued_bytes(tmp_path):
+    receiver = Base64FileReceiver(tmp_path, "a.wav")
+    #  "END1" is four base64 characters, not the end of the upload followed by command 1
+    assert receiver.feed_until_end(b"QUJDEND1") is None
+    assert receiver.feed_until_end(b"END") == b""
+
+
+def frames_of(reader:FrameReader, chunks) -> list[tuple[int, bytes]]:
+    frames = []
+    for chunk in chunks:
+        reader.feed(chunk)
+        #  Payload views are only valid until the buffer is refilled
+        frames += [(frame.type, bytes(frame.payload)) for frame in reader.frames()]
+    return frames
+
+
+@pytest.mark.parametrize("size", [1, 3, 9, 100000])
+def test_frame_reader_split_and_coalesced(size):
+    sent = [(FRAME_SEQUENCE, b"light,20,0,100"), (FRAME_FILE_DATA, os.urandom(5000)), (FRAME_START, b"")]
+    data = b"".join(encode_frame(frame_type, payload, crc=index == 1)
+                    for index, (frame_type, payload) in enumerate(sent))
+    assert frames_of(FrameReader(max_payload=8192), pieces(data, size)) == sent
+
+
+def test_frame_reader_reuses_buffer():
+    reader = FrameReader(max_payload=64)
+    frame = encode_frame(FRAME_FILE_DATA, b"x" * 60)
+    #  Far more data than the buffer holds, consumed frame by frame
+    assert frames_of(reader, [frame] * 50) == [(FRAME_FILE_DATA, b"x" * 60)] * 50
+
+
+def test_frame_reader_rejects_bad_crc():
+    frame = bytearray(encode_frame(FRAME_SEQUENCE, b"light,20,0,100", crc=True))
+    frame[-1] ^= 0xFF
+    reader = FrameReader()
+    reader.feed(bytes(frame))
+    with pytest.raises(ProtocolError):
+        list(reader.frames())
+
+
+def test_frame_reader_rejects_oversized_frame():
+    reader = FrameReader(max_payload=16)
+    reader.feed(encode_frame(FRAME_FILE_DATA, b"x" * 17)[:8])
+    with pytest.raises(ProtocolError):
+        list(reader.frames())
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+@pytest.mark.parametrize("size", [1, 100, 1 << 20])
+def test_decompressor_in_chunks(codec, size):
+    #  Compressible enough to produce several OUTPUT_CHUNK pieces from one chunk
+    content = b"light,20,1000,2000?" * 20000 + os.urandom(1000)
+    decompressor = Decompressor(codec)
+    output = b"".join(piece for chunk in pieces(compress(codec, content) + b"4", size)
+                      for piece in decompressor.feed(chunk))
+    assert output == content
+    assert decompressor.eof
+    assert decompressor.size == len(content)
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_decompressor_limits_output(codec):
+    decompressor = Decompressor(codec, max_output=1000)
+    with pytest.raises(ValueError):
+        b"".join(decompressor.feed(compress(codec, bytes(5000))))